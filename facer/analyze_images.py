@@ -0,0 +1,207 @@
+"""Offline seasonal analysis of a directory or manifest of images, without HTTP.
+
+    python analyze_images.py photos/ -o results.jsonl --workers 4
+    python analyze_images.py --manifest paths.txt -o results.parquet
+
+Each worker process loads the models once and runs images through the feature
+pipeline `--batch-size` at a time, decoding the next batch on a background
+thread while the current one is in the models. Results are appended to a JSONL
+file as they finish (for .parquet outputs to `<output>.jsonl`, converted when
+the run completes), so a run that is interrupted continues where it stopped
+when started again with the same output.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+FEATURES = ("skin", "hair", "lips", "eyes")
+
+
+def iter_paths(root=None, manifest=None):
+    """Image paths under `root` (recursively, sorted) or listed in `manifest`"""
+    if manifest:
+        with open(manifest) as lines:
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+        return
+    for directory, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(directory, name)
+
+
+def load_done(checkpoint):
+    """Paths already in the JSONL checkpoint of an earlier run"""
+    done = set()
+    if not os.path.exists(checkpoint):
+        return done
+    with open(checkpoint, "rb+") as lines:
+        complete = 0
+        for line in lines:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            try:
+                done.add(json.loads(line)["path"])
+            except (ValueError, KeyError):
+                continue
+        # Drop the last line of a run that was killed mid-write, so new
+        # records don't get appended to it
+        lines.truncate(complete)
+    return done
+
+
+# Per worker process state, set up once by _init_worker
+_pipeline = None
+_decoder = None
+
+
+def _init_worker(threads, max_size):
+    global _pipeline, _decoder
+    import torch
+
+    import model_registry
+    from pipeline import FeaturePipeline
+    from result_cache import cache
+
+    torch.set_num_threads(threads)
+    # Every image is seen once, caching results would only cost memory
+    cache.max_entries = 0
+    model_registry.get_face_detector()
+    model_registry.get_face_parser()
+    model_registry.get_skin_model()
+    _pipeline = FeaturePipeline(max_size=max_size)
+    _decoder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+
+
+def _decode(paths):
+    from pipeline import decode_image
+
+    decoded = []
+    for path in paths:
+        try:
+            with open(path, "rb") as image_file:
+                decoded.append(decode_image(image_file.read(), _pipeline.max_size))
+        except (OSError, ValueError) as e:
+            decoded.append(e)
+    return decoded
+
+
+def _record(path, result):
+    from pipeline import SEASON_NAMES, normalize_season
+
+    record = {"path": path}
+    record.update({name: result[name] for name in FEATURES})
+    record["season"] = SEASON_NAMES.get(normalize_season(result["season"]))
+    return record
+
+
+def analyze_chunk(paths, batch_size):
+    """Records of a chunk of paths, run in a worker process"""
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    records = []
+    pending = _decoder.submit(_decode, batches[0])
+    for k, batch in enumerate(batches):
+        decoded = pending.result()
+        if k + 1 < len(batches):
+            pending = _decoder.submit(_decode, batches[k + 1])
+
+        images = [(path, img) for path, img in zip(batch, decoded) if not isinstance(img, Exception)]
+        records.extend({"path": path, "error": str(img)}
+                       for path, img in zip(batch, decoded) if isinstance(img, Exception))
+        if not images:
+            continue
+        try:
+            results = _pipeline.extract_batch([img for _, img in images])
+        except Exception as e:
+            records.extend({"path": path, "error": f"Error: {str(e)}"} for path, _ in images)
+            continue
+        records.extend(_record(path, result) for (path, _), result in zip(images, results))
+    return records
+
+
+def write_parquet(checkpoint, output):
+    """Flatten the JSONL records (hex colour per feature) into a Parquet file"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit(f"Parquet output needs pyarrow (pip install pyarrow); results are in {checkpoint}")
+
+    rows = []
+    with open(checkpoint) as lines:
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            row = {"path": record["path"], "season": record.get("season"), "error": record.get("error")}
+            for name in FEATURES:
+                feature = record.get(name) or {}
+                row[f"{name}_hex"] = feature.get("dominant_color_hex")
+                row[f"{name}_error"] = feature.get("error")
+            rows.append(row)
+    pq.write_table(pa.Table.from_pylist(rows), output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", nargs="?", help="Directory of images (searched recursively)")
+    parser.add_argument("--manifest", help="Text file with one image path per line, instead of a directory")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="Output .jsonl or .parquet file")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads", type=int, help="Torch threads per worker (default: cores / workers)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per model batch")
+    parser.add_argument("--chunk-size", type=int, default=64, help="Images handed to a worker at a time")
+    parser.add_argument("--max-size", type=int, default=600, help="Long side images are downscaled to")
+    args = parser.parse_args()
+    if not args.root and not args.manifest:
+        parser.error("give a directory or --manifest")
+
+    checkpoint = args.output if args.output.endswith(".jsonl") else args.output + ".jsonl"
+    done = load_done(checkpoint)
+    paths = [path for path in iter_paths(args.root, args.manifest) if path not in done]
+    print(f"{len(paths)} images to analyze ({len(done)} already done)")
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    chunks = [paths[i:i + args.chunk_size] for i in range(0, len(paths), args.chunk_size)]
+    # spawn: the workers get a fresh torch instead of a forked copy of its thread pools
+    context = multiprocessing.get_context("spawn")
+
+    start = last_report = time.time()
+    analyzed = errors = 0
+    with open(checkpoint, "a") as out, context.Pool(args.workers, _init_worker,
+                                                    (threads, args.max_size)) as pool:
+        print(f"Running {args.workers} workers x {threads} torch threads")
+        for records in pool.imap_unordered(_analyze_chunk_star, [(chunk, args.batch_size) for chunk in chunks]):
+            for record in records:
+                out.write(json.dumps(record) + "\n")
+            out.flush()
+            analyzed += len(records)
+            errors += sum("error" in record for record in records)
+            now = time.time()
+            if now - last_report >= 10:
+                print(f"{analyzed}/{len(paths)} images, {analyzed / (now - start):.1f} images/sec")
+                last_report = now
+
+    elapsed = time.time() - start
+    rate = analyzed / elapsed if elapsed > 0 else 0.0
+    print(f"Analyzed {analyzed} images ({errors} errors) in {elapsed:.1f}s: {rate:.1f} images/sec")
+    if checkpoint != args.output:
+        write_parquet(checkpoint, args.output)
+        print(f"Wrote {args.output}")
+
+
+def _analyze_chunk_star(args):
+    return analyze_chunk(*args)
+
+
+if __name__ == "__main__":
+    main()
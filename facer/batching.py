@@ -0,0 +1,132 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import functions as f
+import metrics
+import profiling
+
+
+class _Request:
+    __slots__ = ("image", "detector", "future", "context", "submitted")
+
+    def __init__(self, image, detector=None):
+        self.image = image
+        self.detector = detector
+        self.future = Future()
+        # The caller's context, to attribute the batch's stage timings to its endpoint
+        self.context = contextvars.copy_context()
+        self.submitted = time.perf_counter()
+
+
+class BatchScheduler:
+    """Dynamic micro-batching of face segmentation.
+
+    Concurrent callers (the inference executor's workers) submit one image
+    each; a background thread collects requests for up to `max_wait_ms` or
+    until `max_batch` images are waiting, runs them through one batched
+    RetinaFace + FaRL call (`functions.segment_batch`) and hands every caller
+    its own slice (requests for different detectors are run as separate
+    batches). With `max_batch` <= 1 batching is off and `segment` calls
+    `functions.segment_face` directly.
+    """
+
+    def __init__(self, max_batch=None, max_wait_ms=None):
+        self.max_batch = max_batch or int(os.getenv("BATCH_MAX_SIZE", "4"))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None
+                         else float(os.getenv("BATCH_MAX_WAIT_MS", "5"))) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+
+    @property
+    def enabled(self):
+        return self.max_batch > 1
+
+    def segment(self, image, detector=None):
+        """Segment one RGB image, sharing the model call with concurrent requests"""
+        if not self.enabled or profiling.profiling():
+            # A profiled request segments in its own thread, so its profile covers the models
+            return f.segment_face(image, detector)
+        return self.submit(image, detector).result()
+
+    def submit(self, image, detector=None):
+        self._ensure_started()
+        request = _Request(image, detector)
+        self._queue.put(request)
+        return request.future
+
+    def stats(self):
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "images": self.images,
+            "avg_batch_size": round(self.images / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            groups = {}
+            for request in self._collect():
+                groups.setdefault(request.detector, []).append(request)
+            for detector, batch in groups.items():
+                self._run(batch, detector)
+
+    def _run(self, batch, detector):
+        started = time.perf_counter()
+        try:
+            with metrics.collect_stages() as timings:
+                results = f.segment_batch([request.image for request in batch], detector)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        # Results can be fewer than requests, and recording the timings can fail
+        error = RuntimeError("No segmentation result for this image")
+        try:
+            self.batches += 1
+            self.images += len(batch)
+            for request, result in zip(batch, results):
+                stages = [("batch_wait", started - request.submitted)] + timings
+                request.context.run(metrics.record_stages, stages)
+                request.future.set_result(result)
+        except Exception as e:
+            # Don't let it end the scheduler thread, later requests would hang
+            print(f"Batch scheduler error: {e}")
+            error = e
+        finally:
+            # A caller whose future is never resolved would wait forever
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(error)
+
+
+scheduler = BatchScheduler()
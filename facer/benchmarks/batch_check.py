@@ -0,0 +1,80 @@
+"""Check that batching images together doesn't change their results.
+
+    python -m benchmarks.batch_check                  # stand-in models
+    python -m benchmarks.batch_check --real-models
+
+Images of different sizes are run through the feature pipeline one at a time
+and then as one batch (padded to a common size), with the result cache off.
+The features of each image must be the same both ways, and so must what the
+face parser's net is given for it: the stand-in parser ignores its input, so
+the warped face crops are compared too. Exits with status 1 on a mismatch.
+"""
+import argparse
+import sys
+
+import torch.nn as nn
+
+import model_registry
+from benchmarks import synthetic
+
+DEFAULT_SIZES = "450x600,600x800,300x400"
+
+
+class _Recorder(nn.Module):
+    """Wraps the parser's net and keeps a copy of every input it gets"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+        self.inputs = []
+
+    def forward(self, x):
+        self.inputs.extend(x.detach().clone())
+        return self.net(x)
+
+
+def check(sizes, atol):
+    from pipeline import FeaturePipeline
+    from result_cache import cache
+
+    cache.max_entries = 0
+    images = [synthetic.face_image(w, h, 1, seed)[0] for seed, (w, h) in enumerate(sizes)]
+    parser = model_registry.get_face_parser()
+    recorder = parser.net = _Recorder(parser.net)
+    pipeline = FeaturePipeline()
+
+    singles = [pipeline.extract_image(img) for img in images]
+    single_inputs, recorder.inputs = recorder.inputs, []
+    batched = pipeline.extract_batch(images)
+    batched_inputs = recorder.inputs
+
+    ok = True
+    for k, (w, h) in enumerate(sizes):
+        problems = [name for name in singles[k] if singles[k][name] != batched[k][name]]
+        if len(single_inputs) == len(batched_inputs) == len(images):
+            diff = (single_inputs[k] - batched_inputs[k]).abs().max().item()
+            if diff > atol:
+                problems.append(f"parser input (max diff {diff:.3g})")
+        else:
+            problems.append("faces found")
+        ok = ok and not problems
+        print(f"{w}x{h}: {'ok' if not problems else 'differs in ' + ', '.join(problems)}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Image sizes, WxH")
+    parser.add_argument("--atol", type=float, default=1e-3, help="Tolerance on the parser inputs")
+    parser.add_argument("--real-models", action="store_true", help="Use the real models instead of the stand-ins")
+    args = parser.parse_args()
+
+    if not args.real_models:
+        from benchmarks import stub_models
+        stub_models.install()
+    sizes = [tuple(int(d) for d in size.lower().split("x")) for size in args.sizes.split(",")]
+    sys.exit(0 if check(sizes, args.atol) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""Load test of the API against local stand-ins for the models and external APIs.
+
+    python -m benchmarks.loadtest --concurrency 8 --duration 60 -o loadtest.json
+    python -m benchmarks.loadtest --baseline loadtest.json       # compare with an earlier run
+    python -m benchmarks.loadtest --mix image=1,palette_llm=1 --isolated
+
+Starts the stub OpenRouter and SerpAPI servers (`stub_servers`) and the app
+(with `benchmarks.stub_models`, or the real models with --real-models) on free
+local ports and waits for /ready. Then --concurrency clients send requests
+picked by the --mix weights for --duration seconds, after --warmup seconds
+that aren't counted. Every request uploads a different synthetic face and the
+app's result caches are off, so each one runs the whole pipeline. --isolated
+runs each endpoint of the mix on its own, one after the other.
+
+Per endpoint it reports latency percentiles of the successful requests,
+throughput, errors and the peak RSS of the server process tree while the
+endpoint's requests were in flight. With --baseline, metrics that got worse
+by more than --tolerance are flagged and the exit status is 1.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+import numpy as np
+import psutil
+
+from benchmarks import synthetic
+
+FACER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: (method, path)
+ENDPOINTS = {
+    "image": ("POST", "/image"),
+    "lip": ("POST", "/lip"),
+    "analyze_features": ("POST", "/analyze_features"),
+    "palette_llm": ("POST", "/palette_llm?openrouter_api_key=loadtest"),
+    "serpapi": ("GET", "/api/serpapi-proxy"),
+}
+DEFAULT_MIX = "image=4,lip=2,analyze_features=3,palette_llm=1"
+# Metrics compared with the baseline; True if higher is better
+COMPARED = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "rps": True, "peak_rss_mb": False}
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name} (one of {', '.join(ENDPOINTS)})")
+        mix[name] = float(weight or 1)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Servers:
+    """The stub APIs and the app, each in its own process"""
+
+    def __init__(self, real_models=False, llm_delay_ms=0, env=(), log_path=None):
+        self.real_models = real_models
+        self.llm_delay_ms = llm_delay_ms
+        self.extra_env = dict(env)
+        self.log_path = log_path or os.path.join(tempfile.gettempdir(), "loadtest-server.log")
+        self.processes = []
+        self.app = None
+        self.url = None
+
+    def _start(self, args, env):
+        process = subprocess.Popen([sys.executable, "-m"] + args, cwd=FACER_DIR, env=env,
+                                   stdout=self.log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def __enter__(self):
+        self.log = open(self.log_path, "w")
+        env = dict(os.environ, STUB_LLM_DELAY_MS=str(self.llm_delay_ms))
+        llm_port, serpapi_port, app_port = free_port(), free_port(), free_port()
+        for app, port in (("stub_servers:openrouter_app", llm_port), ("stub_servers:serpapi_app", serpapi_port)):
+            self._start(["uvicorn", app, "--port", str(port), "--log-level", "warning"], env)
+
+        env.update({
+            "OPENROUTER_BASE_URL": f"http://127.0.0.1:{llm_port}/api/v1",
+            "SERPAPI_BASE_URL": f"http://127.0.0.1:{serpapi_port}",
+            "SERPAPI_KEY": "loadtest",
+            # Every request should run the pipeline and call the LLM
+            "RESULT_CACHE_SIZE": "0",
+            "LLM_CACHE_SIZE": "0",
+            "SERPAPI_CACHE_SIZE": "0",
+        })
+        env.update(self.extra_env)
+        if self.real_models:
+            args = ["uvicorn", "main:app", "--port", str(app_port), "--log-level", "warning"]
+        else:
+            args = ["benchmarks.stub_models", "--port", str(app_port)]
+        self.app = self._start(args, env)
+        self.url = f"http://127.0.0.1:{app_port}"
+        return self
+
+    def wait_ready(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.app.poll() is not None:
+                break
+            try:
+                if httpx.get(self.url + "/ready", timeout=2).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.5)
+        self.log.flush()
+        with open(self.log_path) as log:
+            tail = log.readlines()[-30:]
+        raise SystemExit("The app didn't become ready:\n" + "".join(tail))
+
+    def __exit__(self, *exc):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.log.close()
+
+
+class RssSampler:
+    """Samples the RSS of a process and its children on a background thread"""
+
+    def __init__(self, pid, interval=0.05):
+        self.process = psutil.Process(pid) if pid else None
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _rss_mb(self):
+        total = 0
+        for process in [self.process] + self.process.children(recursive=True):
+            try:
+                total += process.memory_info().rss
+            except psutil.Error:
+                pass
+        return total / 1024 / 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.samples.append((time.perf_counter(), self._rss_mb()))
+            except psutil.Error:
+                return
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.process is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def peak(self, intervals=None):
+        """Highest sample, overall or within any of the (start, end) intervals"""
+        if intervals is None:
+            values = [rss for _, rss in self.samples]
+        else:
+            starts = np.array([start for start, _ in intervals])
+            ends = np.array([end for _, end in intervals])
+            values = [rss for t, rss in self.samples if np.any((starts <= t) & (t <= ends))]
+        return round(max(values), 1) if values else None
+
+
+def make_uploads(count, width, height):
+    print(f"Generating {count} synthetic {width}x{height} faces...")
+    return [synthetic.face_jpeg(width, height, seed=seed) for seed in range(count)]
+
+
+async def run_load(url, mix, concurrency, duration, warmup, uploads, seed=0, quality="full"):
+    """Send requests for warmup + duration seconds; records of the counted ones"""
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    # Consecutive requests get different images, so concurrent uploads are never identical
+    counter = itertools.count()
+    records = []
+    start = time.perf_counter()
+    measure_from, end = start + warmup, start + warmup + duration
+
+    async def send(client, name):
+        method, path = ENDPOINTS[name]
+        k = next(counter)
+        if method == "GET":
+            return await client.get(path, params={"q": f"{rng.choice(['spring', 'summer', 'autumn', 'winter'])} "
+                                                        f"outfit {k}"})
+        files = {"file": (f"face{k}.jpg", uploads[k % len(uploads)], "image/jpeg")}
+        params = {"quality": quality} if name != "lip" else None
+        return await client.post(path, files=files, params=params)
+
+    async def worker(client):
+        while time.perf_counter() < end:
+            name = rng.choices(names, weights)[0]
+            sent = time.perf_counter()
+            try:
+                status = (await send(client, name)).status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            done = time.perf_counter()
+            if sent >= measure_from and done <= end:
+                records.append({"endpoint": name, "start": sent, "end": done, "status": status})
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=300) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return records
+
+
+def summarize(records, duration, sampler):
+    endpoints = {}
+    for name in sorted({record["endpoint"] for record in records}):
+        mine = [record for record in records if record["endpoint"] == name]
+        ok = [(record["end"] - record["start"]) * 1000 for record in mine if record["status"] == 200]
+        errors = {}
+        for record in mine:
+            if record["status"] != 200:
+                errors[str(record["status"])] = errors.get(str(record["status"]), 0) + 1
+        summary = {"requests": len(mine), "errors": errors, "rps": round(len(ok) / duration, 2)}
+        if ok:
+            p50, p95, p99 = np.percentile(ok, [50, 95, 99])
+            summary.update({"mean_ms": round(float(np.mean(ok)), 1), "p50_ms": round(float(p50), 1),
+                            "p95_ms": round(float(p95), 1), "p99_ms": round(float(p99), 1)})
+        summary["peak_rss_mb"] = sampler.peak([(record["start"], record["end"]) for record in mine])
+        endpoints[name] = summary
+    return endpoints
+
+
+def measure(url, pid, phases, uploads, args):
+    """Run the load phases; all records, the summary per endpoint and the RSS samples"""
+    sampler = RssSampler(pid).start()
+    endpoints, records = {}, []
+    try:
+        for phase in phases:
+            print(f"Load: {', '.join(f'{name}={weight:g}' for name, weight in phase.items())}, "
+                  f"{args.concurrency} clients, {args.warmup:g}s warm-up + {args.duration:g}s")
+            phase_records = asyncio.run(run_load(url, phase, args.concurrency, args.duration, args.warmup,
+                                                 uploads, args.seed, args.quality))
+            endpoints.update(summarize(phase_records, args.duration, sampler))
+            records.extend(phase_records)
+    finally:
+        sampler.stop()
+    return records, endpoints, sampler
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=FACER_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'endpoint':<18}{'requests':>9}{'errors':>8}{'rps':>8}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'peak MB':>9}")
+    rows = dict(results["endpoints"], total=results["total"])
+    for name, row in rows.items():
+        values = [row.get(key) for key in ("p50_ms", "p95_ms", "p99_ms", "peak_rss_mb")]
+        p50, p95, p99, peak = ("-" if value is None else value for value in values)
+        errors = sum(row["errors"].values()) if isinstance(row["errors"], dict) else row["errors"]
+        print(f"{name:<18}{row['requests']:>9}{errors:>8}{row['rps']:>8}{p50:>10}{p95:>10}{p99:>10}{peak:>9}")
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every compared metric; names of the ones that regressed"""
+    if baseline.get("config", {}).get("mix") != results["config"]["mix"]:
+        print("\nNote: the baseline was run with a different mix")
+    print(f"\n{'vs baseline':<30}{'baseline':>12}{'current':>12}{'change':>10}")
+    regressions = []
+    current_rows = dict(results["endpoints"], total=results["total"])
+    baseline_rows = dict(baseline.get("endpoints", {}), total=baseline.get("total", {}))
+    for name, row in current_rows.items():
+        for metric, higher_is_better in COMPARED.items():
+            old, new = baseline_rows.get(name, {}).get(metric), row.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = "  REGRESSION" if worse > tolerance else ""
+            if flag:
+                regressions.append(f"{name}.{metric}")
+            print(f"{name + ' ' + metric:<30}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Endpoint weights, e.g. image=4,lip=2")
+    parser.add_argument("--concurrency", type=int, default=8, help="Clients sending requests at once")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds measured (per endpoint with --isolated)")
+    parser.add_argument("--warmup", type=float, default=10, help="Seconds of load before measuring")
+    parser.add_argument("--isolated", action="store_true", help="Run each endpoint of the mix on its own")
+    parser.add_argument("--images", type=int, default=64, help="Distinct synthetic uploads")
+    parser.add_argument("--size", default="800x1000", help="Upload size, WIDTHxHEIGHT")
+    parser.add_argument("--llm-delay-ms", type=int, default=0, help="Latency of the stub LLM")
+    parser.add_argument("--quality", default="full", help="quality parameter of the uploads (full or fast)")
+    parser.add_argument("--real-models", action="store_true", help="Use the real models instead of the stand-ins")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the app, e.g. INFERENCE_WORKERS=4")
+    parser.add_argument("--url", help="Test an already running app instead of starting one")
+    parser.add_argument("--server-pid", type=int, help="Process to sample the RSS of, with --url")
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Relative change flagged as a regression")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    width, height = (int(value) for value in args.size.lower().split("x"))
+    uploads = make_uploads(args.images, width, height)
+    env = [item.split("=", 1) for item in args.env]
+    phases = [{name: 1.0} for name in mix] if args.isolated else [mix]
+
+    if args.url:
+        records, endpoints, sampler = measure(args.url.rstrip("/"), args.server_pid, phases, uploads, args)
+    else:
+        with Servers(args.real_models, args.llm_delay_ms, env) as servers:
+            print(f"Starting the app ({'real' if args.real_models else 'stand-in'} models), log in {servers.log_path}")
+            servers.wait_ready(args.ready_timeout)
+            records, endpoints, sampler = measure(servers.url, servers.app.pid, phases, uploads, args)
+
+    total_duration = args.duration * len(phases)
+    succeeded = sum(record["status"] == 200 for record in records)
+    results = {
+        "config": {"mix": mix, "concurrency": args.concurrency, "duration": args.duration,
+                   "warmup": args.warmup, "isolated": args.isolated, "size": args.size, "quality": args.quality,
+                   "models": "real" if args.real_models else "stand-in", "llm_delay_ms": args.llm_delay_ms,
+                   "env": dict(env), "commit": git_commit()},
+        "endpoints": endpoints,
+        "total": {"requests": len(records), "errors": len(records) - succeeded,
+                  "rps": round(succeeded / total_duration, 2), "peak_rss_mb": sampler.peak()},
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+        print(f"\nWrote {args.output}")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""Micro-benchmarks of the hot functions of the pipeline, one stage at a time.
+
+    python -m benchmarks.micro -o bench.json
+    python -m benchmarks.micro -k nms -k prior --sizes 450x600,1500x2000 --faces 1,5
+    python -m benchmarks.micro -o after.json --compare before.json
+    python -m benchmarks.micro --load after.json --compare before.json
+
+Works like pytest-benchmark: every case is called for at least --min-rounds
+rounds and until --max-time seconds have passed, each round calling it enough
+times to take --min-round-time, and the per-call min/median/mean/stddev/IQR
+are reported. Cases are parametrized by image size and face count where
+those matter. Models are the stand-ins of `benchmarks.stub_models` (real
+architectures, random weights) unless --real-models is given; their random
+outputs have no detections, so the detector's post-processing and NMS are
+timed on canned outputs with realistic clusters of candidates around each face.
+Results are saved as JSON with the commit and machine they were taken on.
+"""
+import argparse
+import atexit
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+import functions as f
+import model_registry
+from benchmarks import synthetic
+from benchmarks.loadtest import git_commit
+from facer.face_detection import retinaface
+from facer.face_parsing.farl import pretrain_settings
+from facer.io import read_hwc
+from facer.transform import make_inverted_tanh_warp_grid, make_tanh_warp_grid
+from facer.util import hwc2bchw
+
+DEFAULT_SIZES = "450x600,900x1200,1500x2000"
+DEFAULT_FACES = "1,3"
+DEFAULT_PIXELS = "40,1000"
+
+# (name, group, parameter axes, setup); setup(**params) returns the function to time
+BENCHMARKS = []
+
+
+def benchmark(group, axes=("size",)):
+    def register(setup):
+        BENCHMARKS.append((setup.__name__[len("bench_"):], group, axes, setup))
+        return setup
+    return register
+
+
+def _image(size, faces=1):
+    width, height = size
+    return synthetic.face_image(width, height, faces)
+
+
+def _batch(img):
+    return hwc2bchw(torch.from_numpy(img)).to(device=model_registry.get_device())
+
+
+def canned_detector_outputs(height, width, boxes, seed=0):
+    """(loc, conf, landms) of a RetinaFace that found the faces at `boxes`.
+
+    Anchors centred in a face with a size close to it score 0.85-0.99 and
+    decode to the face with some jitter, as the trained net's do; a few
+    random anchors elsewhere score just above the 0.8 threshold.
+    """
+    rng = np.random.default_rng(seed)
+    priors = retinaface.PriorBox(retinaface.cfg_mnet, image_size=(height, width)).forward().numpy()
+    n = len(priors)
+    centers, sizes = priors[:, :2], priors[:, 2:]
+    variance = retinaface.cfg_mnet["variance"]
+    scale = np.array([width, height], np.float32)
+
+    scores = rng.uniform(0.0, 0.3, n)
+    loc = rng.normal(0, 0.5, (n, 4))
+    landms = rng.normal(0, 0.5, (n, 10))
+    background = rng.random(n) < 0.002
+    scores[background] = rng.uniform(0.8, 0.85, background.sum())
+    for box in boxes:
+        x1, y1, x2, y2 = np.array(box) / np.tile(scale, 2)
+        face_center = np.array([(x1 + x2) / 2, (y1 + y2) / 2])
+        face_size = np.array([x2 - x1, y2 - y1])
+        inside = np.all(np.abs(centers - face_center) < face_size / 4, axis=1)
+        ratio = sizes[:, 0] / face_size[0]
+        hits = inside & (ratio > 0.4) & (ratio < 2.5)
+        k = hits.sum()
+        scores[hits] = rng.uniform(0.85, 0.99, k)
+        jitter = rng.normal(0, 0.02, (k, 2)) * face_size
+        loc[hits, :2] = (face_center + jitter - centers[hits]) / (variance[0] * sizes[hits])
+        loc[hits, 2:] = np.log(face_size * rng.normal(1, 0.05, (k, 2)) / sizes[hits]) / variance[1]
+        points = np.array(synthetic.landmarks(box)) / scale
+        landms[hits] = ((points[None] - centers[hits, None]) / (variance[0] * sizes[hits, None])).reshape(k, 10)
+
+    conf = np.stack([1 - scores, scores], axis=1)
+    return tuple(torch.from_numpy(x.astype(np.float32)).unsqueeze(0) for x in (loc, conf, landms))
+
+
+class _CannedNet(torch.nn.Module):
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = outputs
+
+    def forward(self, images):
+        return tuple(x.expand(images.shape[0], *x.shape[1:]) for x in self.outputs)
+
+
+@benchmark("facer.io", axes=("size",))
+def bench_hwc2bchw(size):
+    img, _ = _image(size)
+    return lambda: hwc2bchw(torch.from_numpy(img))
+
+
+@benchmark("facer.io", axes=("size",))
+def bench_read_hwc(size):
+    handle, path = tempfile.mkstemp(suffix=".jpg")
+    os.close(handle)
+    atexit.register(os.remove, path)
+    with open(path, "wb") as out:
+        out.write(synthetic.face_jpeg(*size))
+    return lambda: read_hwc(path)
+
+
+@benchmark("retinaface", axes=("size",))
+def bench_batch_detect(size):
+    detector = model_registry.get_face_detector()
+    image = _batch(_image(size)[0])
+    return lambda: retinaface.batch_detect(detector.net, image, threshold=0.8)
+
+
+@benchmark("retinaface", axes=("size",))
+def bench_downscaled_detect(size):
+    detector = model_registry.get_face_detector()
+    image = _batch(_image(size)[0])
+    return lambda: retinaface.downscaled_detect(detector.net, image, threshold=0.8,
+                                                max_size=model_registry.FAST_DETECT_SIZE)
+
+
+@benchmark("retinaface", axes=("size", "faces"))
+def bench_batch_detect_postprocess(size, faces):
+    img, boxes = _image(size, faces)
+    image = _batch(img)
+    net = _CannedNet(canned_detector_outputs(img.shape[0], img.shape[1], boxes))
+    return lambda: retinaface.batch_detect(net, image, threshold=0.8)
+
+
+@benchmark("retinaface", axes=("size",))
+def bench_priorbox_forward(size):
+    width, height = size
+    return lambda: retinaface.PriorBox(retinaface.cfg_mnet, image_size=(height, width)).forward()
+
+
+@benchmark("retinaface", axes=("size",))
+def bench_priorbox_forward_uncached(size):
+    width, height = size
+
+    def run():
+        retinaface._prior_boxes.cache_clear()
+        return retinaface.PriorBox(retinaface.cfg_mnet, image_size=(height, width)).forward()
+    return run
+
+
+@benchmark("retinaface", axes=("size", "faces"))
+def bench_py_cpu_nms(size, faces):
+    width, height = size
+    loc, conf, _ = canned_detector_outputs(height, width, synthetic.face_boxes(width, height, faces))
+    priors = retinaface.PriorBox(retinaface.cfg_mnet, image_size=(height, width)).forward()
+    boxes = retinaface.decode(loc[0], priors, retinaface.cfg_mnet["variance"]).numpy()
+    boxes *= np.array([width, height, width, height], np.float32)
+    scores = conf[0, :, 1].numpy()
+    keep = scores > 0.8
+    dets = np.hstack((boxes[keep], scores[keep, None])).astype(np.float32)
+    dets = dets[dets[:, 4].argsort()[::-1]]
+    return lambda: retinaface.py_cpu_nms(dets, 0.4)
+
+
+@benchmark("farl", axes=("size", "faces"))
+def bench_farl_forward(size, faces):
+    parser = model_registry.get_face_parser()
+    img, boxes = _image(size, faces)
+    image = _batch(img)
+    data = synthetic.detection(torch, boxes)
+
+    def run():
+        with torch.inference_mode():
+            return parser(image, dict(data))
+    return run
+
+
+def _warp_matrix(size, faces):
+    width, height = size
+    points = synthetic.detection(torch, synthetic.face_boxes(width, height, faces))['points']
+    return pretrain_settings['lapa/448']['get_matrix_fn'](points)
+
+
+@benchmark("farl", axes=("size", "faces"))
+def bench_make_tanh_warp_grid(size, faces):
+    matrix = _warp_matrix(size, faces)
+    width, height = size
+    return lambda: make_tanh_warp_grid(matrix, 0.8, (448, 448), (height, width))
+
+
+@benchmark("farl", axes=("size", "faces"))
+def bench_make_inverted_tanh_warp_grid(size, faces):
+    matrix = _warp_matrix(size, faces)
+    width, height = size
+    return lambda: make_inverted_tanh_warp_grid(matrix, 0.8, (448, 448), (height, width))
+
+
+@benchmark("functions", axes=("size",))
+def bench_get_eye_color(size):
+    data = synthetic.face_jpeg(*size)
+    return lambda: f.get_eye_color(data)
+
+
+@benchmark("functions", axes=("pixels",))
+def bench_calc_dis(pixels):
+    rgb_codes = np.random.default_rng(0).integers(0, 256, (pixels, 3))
+    return lambda: f.calc_dis(rgb_codes)
+
+
+@benchmark("functions", axes=("size", "faces"))
+def bench_dominant_color(size, faces):
+    img, boxes = _image(size, faces)
+    mask = np.zeros(img.shape[:2], np.uint8)
+    for x1, y1, x2, y2 in boxes:
+        cv2.ellipse(mask, (int((x1 + x2) / 2), int((y1 + y2) / 2)), (int((x2 - x1) / 2), int((y2 - y1) / 2)),
+                    0, 0, 360, 1, -1)
+    pixels = img[mask > 0]
+    return lambda: f.dominant_color(pixels)
+
+
+@benchmark("skin_model", axes=("size",))
+def bench_skin_predict(size):
+    skin = model_registry.get_skin_model()
+    img, _ = _image(size)
+    return lambda: skin.predict(img)
+
+
+def measure(fn, min_rounds, max_time, min_round_time):
+    """Per-call statistics (seconds) of `fn`, after one warm-up call"""
+    fn()
+    start = time.perf_counter()
+    fn()
+    once = time.perf_counter() - start
+    iterations = max(1, int(min_round_time / once)) if once > 0 else 1000
+    rounds = []
+    deadline = time.perf_counter() + max_time
+    while len(rounds) < min_rounds or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        rounds.append((time.perf_counter() - start) / iterations)
+    rounds = np.array(rounds)
+    q1, median, q3 = np.percentile(rounds, [25, 50, 75])
+    return {
+        "min": float(rounds.min()), "max": float(rounds.max()), "mean": float(rounds.mean()),
+        "stddev": float(rounds.std(ddof=1)) if len(rounds) > 1 else 0.0,
+        "median": float(median), "q1": float(q1), "q3": float(q3), "iqr": float(q3 - q1),
+        "rounds": len(rounds), "iterations": iterations, "ops": float(1 / rounds.mean()),
+    }
+
+
+def _cases(axes, values):
+    cases = [{}]
+    for axis in axes:
+        cases = [dict(case, **{axis: value}) for case in cases for value in values[axis]]
+    return cases
+
+
+def _case_id(params):
+    parts = []
+    for axis, value in params.items():
+        if axis == "size":
+            parts.append("%dx%d" % value)
+        else:
+            parts.append(f"{value}{axis}")
+    return "-".join(parts)
+
+
+def run(patterns, values, min_rounds, max_time, min_round_time):
+    results = []
+    for name, group, axes, setup in BENCHMARKS:
+        for params in _cases(axes, values):
+            full_name = f"{name}[{_case_id(params)}]" if params else name
+            if patterns and not any(fnmatch.fnmatch(full_name, f"*{p}*") for p in patterns):
+                continue
+            fn = setup(**params)
+            stats = measure(fn, min_rounds, max_time, min_round_time)
+            print(f"{full_name:<58}{stats['median'] * 1000:>12.3f} ms  (iqr {stats['iqr'] * 1000:.3f}, "
+                  f"{stats['rounds']} x {stats['iterations']})", flush=True)
+            results.append({"name": full_name, "group": group, "params": {
+                key: ("%dx%d" % value if key == "size" else value) for key, value in params.items()},
+                "stats": stats})
+    return results
+
+
+def machine_info():
+    return {
+        "python": platform.python_version(), "platform": platform.platform(), "machine": platform.machine(),
+        "cpu_count": os.cpu_count(), "torch": torch.__version__, "torch_threads": torch.get_num_threads(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every median; names of the ones slower by more than `tolerance`"""
+    old = {bench["name"]: bench["stats"]["median"] for bench in baseline["benchmarks"]}
+    regressions = []
+    print(f"\n{'vs baseline (median)':<58}{'baseline ms':>13}{'current ms':>13}{'change':>10}")
+    for bench in results["benchmarks"]:
+        before, after = old.get(bench["name"]), bench["stats"]["median"]
+        if not before:
+            continue
+        change = (after - before) / before
+        flag = "  REGRESSION" if change > tolerance else ""
+        if flag:
+            regressions.append(bench["name"])
+        print(f"{bench['name']:<58}{before * 1000:>13.3f}{after * 1000:>13.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", dest="patterns", action="append", default=[],
+                        help="Only run cases whose name contains this (glob, repeatable)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Image sizes, WIDTHxHEIGHT, comma separated")
+    parser.add_argument("--faces", default=DEFAULT_FACES, help="Face counts, comma separated")
+    parser.add_argument("--pixels", default=DEFAULT_PIXELS, help="Pixel counts for calc_dis, comma separated")
+    parser.add_argument("--min-rounds", type=int, default=5)
+    parser.add_argument("--max-time", type=float, default=1.0, help="Seconds spent per case, at least")
+    parser.add_argument("--min-round-time", type=float, default=0.005, help="Seconds per round, at least")
+    parser.add_argument("--threads", type=int, help="Torch threads (default: torch's choice)")
+    parser.add_argument("--real-models", action="store_true", help="Use the real models instead of the stand-ins")
+    parser.add_argument("-o", "--output", help="Write the results to this JSON file")
+    parser.add_argument("--load", help="Don't run, compare the results saved in this file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.load:
+        with open(args.load) as results_file:
+            results = json.load(results_file)
+    else:
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        if not args.real_models:
+            from benchmarks import stub_models
+            stub_models.install()
+        values = {
+            "size": [tuple(int(v) for v in size.lower().split("x")) for size in args.sizes.split(",")],
+            "faces": [int(v) for v in args.faces.split(",")],
+            "pixels": [int(v) for v in args.pixels.split(",")],
+        }
+        benchmarks = run(args.patterns, values, args.min_rounds, args.max_time, args.min_round_time)
+        results = {
+            "datetime": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "models": "real" if args.real_models else "stand-in",
+            "machine_info": machine_info(),
+            "benchmarks": benchmarks,
+        }
+        if args.output:
+            with open(args.output, "w") as out:
+                json.dump(results, out, indent=2)
+            print(f"\nWrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
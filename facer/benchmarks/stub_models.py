@@ -0,0 +1,172 @@
+"""Stand-in models for load tests and benchmarks on machines without the weights.
+
+    python -m benchmarks.stub_models --port 8000    # main:app with the stand-ins
+
+Each stand-in has the architecture of the model it replaces with random
+weights, so it costs about as much CPU time and memory as the real one:
+
+- detector: the RetinaFace mobilenet net and its post-processing, also
+  for the fast (downscaled) detector of quality=fast
+- parser: FaRL's warp, a ViT-B sized transformer (STUB_PARSER_LAYERS layers,
+  12 by default) and the inverse warp
+- skin classifier: ResNet18 with the real preprocessing
+
+Random weights give meaningless outputs, so the detector reports the face
+where `benchmarks.synthetic` draws it (in each image's own size, also when
+it is padded into a batch) and the parser's logits are replaced by
+the drawn regions; everything downstream sees plausible masks.
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import functions as f
+import model_registry
+from benchmarks import synthetic
+from facer.face_detection import retinaface
+from facer.face_parsing.farl import FaRLFaceParser
+from skin_model import LazySkinModel
+
+LABEL_NAMES = ['background', 'face', 'rb', 'lb', 're', 'le', 'nose', 'ulip', 'imouth', 'llip', 'hair']
+
+
+class StubDetector(retinaface.RetinaFaceDetector):
+    def __init__(self, max_size=None):
+        nn.Module.__init__(self)
+        torch.manual_seed(0)
+        self.max_size = max_size
+        self.net = retinaface.RetinaFace(cfg=retinaface.cfg_mnet, phase='test')
+
+    def forward(self, images):
+        retinaface.downscaled_detect(self.net, images, threshold=0.8, max_size=self.max_size)
+        boxes = [synthetic.face_boxes(w, h, 1)[0] for h, w in map(_unpadded_size, images)]
+        return {
+            'rects': torch.tensor(boxes, dtype=torch.float32),
+            'points': torch.tensor([synthetic.landmarks(box) for box in boxes], dtype=torch.float32),
+            'scores': torch.ones(len(boxes)),
+            'image_ids': torch.arange(len(boxes)),
+        }
+
+
+def _unpadded_size(image):
+    """Height and width of an image of a batch padded by `functions._pad_batch`"""
+    pad = torch.tensor(f.DETECTOR_PAD_VALUE, dtype=image.dtype, device=image.device).view(3, 1, 1)
+    content = (image != pad).any(0)
+    rows, cols = content.any(1).nonzero(), content.any(0).nonzero()
+    if len(rows) == 0:
+        return image.shape[1:]
+    return int(rows[-1]) + 1, int(cols[-1]) + 1
+
+
+class _ViTSegmenter(nn.Module):
+    """ViT-B/16 shaped segmenter: patch embedding, transformer, per-patch logits"""
+
+    def __init__(self, layers, width=768, heads=12, patch=16, classes=len(LABEL_NAMES)):
+        super().__init__()
+        self.patch = patch
+        self.embed = nn.Conv2d(3, width, patch, stride=patch)
+        # Sequence first: the batch_first fast path has no ONNX export
+        layer = nn.TransformerEncoderLayer(width, heads, width * 4, activation='gelu')
+        self.encoder = nn.TransformerEncoder(layer, layers)
+        self.head = nn.Conv2d(width, classes, 1)
+
+    def forward(self, images):
+        x = self.embed(images)
+        b, c, h, w = x.shape
+        x = self.encoder(x.flatten(2).permute(2, 0, 1)).permute(1, 2, 0).reshape(b, c, h, w)
+        logits = F.interpolate(self.head(x), scale_factor=self.patch, mode='bilinear', align_corners=False)
+        return logits, None
+
+
+def _label_map(h, w, rect, points):
+    """Labels of the face regions `synthetic` draws for a face at `rect`"""
+    x1, y1, x2, y2 = rect
+    bw, bh = x2 - x1, y2 - y1
+    labels = np.zeros((h, w), np.uint8)
+    center = (int((x1 + x2) / 2), int((y1 + y2) / 2))
+    cv2.ellipse(labels, center, (int(bw / 2), int(bh / 2)), 0, 0, 360, 1, -1)
+    cv2.ellipse(labels, (center[0], int(y1 + bh * .05)), (int(bw * .55), int(bh * .2)), 0, 180, 360, 10, -1)
+    for (x, y), label in zip(points[:2], (5, 4)):
+        cv2.ellipse(labels, (int(x), int(y)), (max(2, int(bw * .07)), max(1, int(bh * .03))), 0, 0, 360, label, -1)
+    (lx, ly), (rx, ry) = points[3], points[4]
+    mouth = (int((lx + rx) / 2), int((ly + ry) / 2))
+    axes = (max(2, int((rx - lx) / 2)), max(1, int(bh * .035)))
+    cv2.ellipse(labels, mouth, axes, 0, 180, 360, 7, -1)
+    cv2.ellipse(labels, mouth, axes, 0, 0, 180, 9, -1)
+    return labels
+
+
+class StubParser(FaRLFaceParser):
+    def __init__(self, layers=None):
+        nn.Module.__init__(self)
+        torch.manual_seed(0)
+        self.conf_name = 'lapa/448'
+        self.net = _ViTSegmenter(layers or int(os.getenv("STUB_PARSER_LAYERS", "12")))
+
+    def forward(self, images, data):
+        data = super().forward(images, data)
+        _, _, h, w = images.shape
+        labels = [_label_map(h, w, rect.tolist(), points.tolist())
+                  for rect, points in zip(data['rects'], data['points'])]
+        labels = torch.from_numpy(np.stack(labels)).long() if labels else torch.zeros(0, h, w, dtype=torch.long)
+        logits = F.one_hot(labels, len(LABEL_NAMES)).permute(0, 3, 1, 2).float() * 8
+        data['seg'] = {'logits': logits.to(images.device), 'label_names': LABEL_NAMES}
+        return data
+
+
+class StubSkinModel(LazySkinModel):
+    _instance = None
+
+    def _load_model(self):
+        if not self._loaded:
+            import torchvision.models as models
+            import torchvision.transforms as transforms
+
+            torch.manual_seed(0)
+            self._model = models.resnet18(num_classes=4)
+            self._transform = transforms.Compose([
+                transforms.Resize((160, 160)),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5,), (0.5,))
+            ])
+            self._model.eval()
+            self._loaded = True
+
+
+def _stub_skin_model():
+    model = StubSkinModel()
+    model._load_model()
+    return model
+
+
+def install():
+    """Register the stand-ins in the model registry, before any model is loaded"""
+    registry = model_registry.registry
+    registry.register(f'detector:{model_registry.DEFAULT_DETECTOR}',
+                      lambda: StubDetector().to(model_registry.get_device()))
+    registry.register(f'detector:{model_registry.detector_name("fast")}',
+                      lambda: StubDetector(model_registry.FAST_DETECT_SIZE).to(model_registry.get_device()))
+    registry.register(f'parser:{model_registry.DEFAULT_PARSER}',
+                      lambda: StubParser().to(model_registry.get_device()))
+    registry.register('skin:resnet18', _stub_skin_model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run main:app with the stand-in models")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    install()
+    uvicorn.run("main:app", host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Synthetic face images for the load test and the benchmarks.
+
+Faces are drawn as cartoons (skin, hair, eyes, lips) with colours, background
+and noise picked from a seeded generator, so every seed gives a different
+upload (no cache hits) and the same seed always gives the same image.
+"""
+import math
+
+import cv2
+import numpy as np
+
+SKIN_TONES = [(255, 219, 190), (241, 194, 167), (224, 172, 140), (198, 134, 98), (141, 85, 54), (92, 58, 38)]
+HAIR_COLORS = [(20, 20, 20), (60, 40, 30), (120, 50, 30), (150, 100, 50), (220, 190, 120)]
+LIP_COLORS = [(170, 80, 90), (200, 100, 110), (150, 60, 70), (190, 120, 120)]
+IRIS_COLORS = [(60, 40, 30), (70, 90, 120), (80, 120, 80), (100, 140, 180)]
+
+# Five landmarks (eyes, nose, mouth corners) relative to the face box,
+# the same layout as `warmup.synthetic_detection`
+LANDMARKS = [(0.34, 0.42), (0.66, 0.42), (0.5, 0.55), (0.38, 0.68), (0.62, 0.68)]
+
+
+def face_boxes(width, height, faces=1):
+    """Boxes (x1, y1, x2, y2) of `faces` faces laid out on a grid"""
+    cols = math.ceil(math.sqrt(faces))
+    rows = math.ceil(faces / cols)
+    cell_w, cell_h = width / cols, height / rows
+    boxes = []
+    for k in range(faces):
+        x0, y0 = (k % cols) * cell_w, (k // cols) * cell_h
+        boxes.append((x0 + cell_w * .25, y0 + cell_h * .17, x0 + cell_w * .75, y0 + cell_h * .83))
+    return boxes
+
+
+def landmarks(box):
+    x1, y1, x2, y2 = box
+    return [(x1 + (x2 - x1) * u, y1 + (y2 - y1) * v) for u, v in LANDMARKS]
+
+
+def _pick(rng, colors):
+    base = np.array(colors[rng.integers(len(colors))])
+    return tuple(int(c) for c in (base + rng.integers(-12, 13, 3)).clip(0, 255))
+
+
+def _draw_face(img, box, rng):
+    x1, y1, x2, y2 = box
+    bw, bh = x2 - x1, y2 - y1
+    center = (int((x1 + x2) / 2), int((y1 + y2) / 2))
+    cv2.ellipse(img, center, (int(bw / 2), int(bh / 2)), 0, 0, 360, _pick(rng, SKIN_TONES), -1)
+    cv2.ellipse(img, (center[0], int(y1 + bh * .05)), (int(bw * .55), int(bh * .2)), 0, 180, 360,
+                _pick(rng, HAIR_COLORS), -1)
+    points = landmarks(box)
+    iris = _pick(rng, IRIS_COLORS)
+    for x, y in points[:2]:
+        cv2.ellipse(img, (int(x), int(y)), (max(2, int(bw * .07)), max(1, int(bh * .03))), 0, 0, 360,
+                    (245, 245, 245), -1)
+        cv2.circle(img, (int(x), int(y)), max(1, int(bw * .03)), iris, -1)
+    (lx, ly), (rx, ry) = points[3], points[4]
+    cv2.ellipse(img, (int((lx + rx) / 2), int((ly + ry) / 2)), (max(2, int((rx - lx) / 2)), max(1, int(bh * .035))),
+                0, 0, 360, _pick(rng, LIP_COLORS), -1)
+
+
+def face_image(width=600, height=600, faces=1, seed=0):
+    """RGB image (height x width x 3, uint8) with `faces` faces, and their boxes"""
+    rng = np.random.default_rng(seed)
+    background = rng.integers(150, 256, 3)
+    img = np.empty((height, width, 3), np.uint8)
+    img[:] = background.astype(np.uint8)
+    boxes = face_boxes(width, height, faces)
+    for box in boxes:
+        _draw_face(img, box, rng)
+    noise = rng.integers(-6, 7, img.shape, dtype=np.int16)
+    img = (img.astype(np.int16) + noise).clip(0, 255).astype(np.uint8)
+    return img, boxes
+
+
+def face_jpeg(width=600, height=600, faces=1, seed=0, quality=90):
+    """`face_image` encoded as a JPEG upload"""
+    img, _ = face_image(width, height, faces, seed)
+    ok, data = cv2.imencode(".jpg", cv2.cvtColor(img, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not encode image")
+    return data.tobytes()
+
+
+def detection(torch, boxes):
+    """Detections of the faces at `boxes` of one image, in the detector's output format"""
+    return {
+        'rects': torch.tensor([list(box) for box in boxes], dtype=torch.float32),
+        'points': torch.tensor([landmarks(box) for box in boxes], dtype=torch.float32),
+        'scores': torch.ones(len(boxes)),
+        'image_ids': torch.zeros(len(boxes), dtype=torch.long),
+    }
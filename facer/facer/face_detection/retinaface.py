@@ -7,10 +7,11 @@ import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models._utils as _utils
+from torchvision.ops import batched_nms
 from .base import FaceDetector
 
 
-from itertools import product as product
+import functools
 from math import ceil
 
 
@@ -372,28 +373,42 @@ class PriorBox(object):
         ]
         self.name = "s"
 
-    def forward(self):
-        anchors = []
-        for k, f in enumerate(self.feature_maps):
-            min_sizes = self.min_sizes[k]
-            for i, j in product(range(f[0]), range(f[1])):
-                for min_size in min_sizes:
-                    s_kx = min_size / self.image_size[1]
-                    s_ky = min_size / self.image_size[0]
-                    dense_cx = [
-                        x * self.steps[k] / self.image_size[1] for x in [j + 0.5]
-                    ]
-                    dense_cy = [
-                        y * self.steps[k] / self.image_size[0] for y in [i + 0.5]
-                    ]
-                    for cy, cx in product(dense_cy, dense_cx):
-                        anchors += [cx, cy, s_kx, s_ky]
-
-        # back to torch land
-        output = torch.Tensor(anchors).view(-1, 4)
-        if self.clip:
-            output.clamp_(max=1, min=0)
-        return output
+    def forward(self, device=None):
+        """Anchors (cx, cy, s_kx, s_ky) as an n x 4 tensor on `device`.
+
+        Cached per image size and device: the tensor is shared between
+        calls, so it must not be modified in place.
+        """
+        return _prior_boxes(
+            self.image_size[0], self.image_size[1],
+            tuple(tuple(sizes) for sizes in self.min_sizes), tuple(self.steps),
+            self.clip, torch.device(device or "cpu"))
+
+
+@functools.lru_cache(maxsize=32)
+def _prior_boxes(height, width, min_sizes, steps, clip, device):
+    anchors = []
+    for sizes, step in zip(min_sizes, steps):
+        rows, cols = ceil(height / step), ceil(width / step)
+        # float64 like the Python floats the anchors used to be computed with
+        cy, cx = torch.meshgrid(
+            (torch.arange(rows, dtype=torch.float64) + 0.5) * step / height,
+            (torch.arange(cols, dtype=torch.float64) + 0.5) * step / width,
+            indexing="ij")
+        sizes = torch.tensor(sizes, dtype=torch.float64)
+        shape = (rows, cols, len(sizes))
+        # Row by row, column by column, one anchor per min size: the order of the net's outputs
+        anchors.append(torch.stack([
+            cx[:, :, None].expand(shape),
+            cy[:, :, None].expand(shape),
+            (sizes / width).expand(shape),
+            (sizes / height).expand(shape),
+        ], dim=-1).reshape(-1, 4))
+
+    output = torch.cat(anchors).float()
+    if clip:
+        output.clamp_(max=1, min=0)
+    return output.to(device)
 
 
 cfg_mnet = {
@@ -499,66 +514,44 @@ def load_net(model_path, network="mobilenet"):
     return net
 
 
-def parse_det(det) -> Tuple[torch.Tensor, torch.Tensor, float]:
-    landmarks = det[5:].reshape(5, 2)
-    box = det[:4]
-    score = det[4]
-    return torch.from_numpy(box), torch.from_numpy(landmarks), score
-
-
-def post_process(
-    loc,
-    conf,
-    landms,
-    prior_data,
-    cfg,
-    scale,
-    scale1,
-    resize,
-    confidence_threshold,
-    top_k,
-    nms_threshold,
-    keep_top_k,
-):
-    boxes = decode(loc, prior_data, cfg["variance"])
-    boxes = boxes * scale / resize
-    boxes = boxes.cpu().numpy()
-    scores = conf.cpu().numpy()[:, 1]
-    landms_copy = decode_landm(landms, prior_data, cfg["variance"])
-
-    landms_copy = landms_copy * scale1 / resize
-    landms_copy = landms_copy.cpu().numpy()
-
-    # ignore low scores
-    inds = np.where(scores > confidence_threshold)[0]
-    boxes = boxes[inds]
-    landms_copy = landms_copy[inds]
-    scores = scores[inds]
+def _rank_in_image(image_ids, num_images):
+    """Position of each candidate among those of its image, in the current order"""
+    one_hot = F.one_hot(image_ids, num_images)
+    return (one_hot.cumsum(0) * one_hot).sum(1) - 1
 
-    # keep top-K before NMS
-    order = scores.argsort()[::-1][:top_k]
-    boxes = boxes[order]
-    landms_copy = landms_copy[order]
-    scores = scores[order]
 
-    # do NMS
-    dets = np.hstack((boxes, scores[:, np.newaxis])).astype(
-        np.float32, copy=False)
-    keep = py_cpu_nms(dets, nms_threshold)
-    # keep = nms(dets, args.nms_threshold,force_cpu=args.cpu)
-    dets = dets[keep, :]
-    landms_copy = landms_copy[keep]
+def post_process(loc, conf, landms, prior_data, cfg, confidence_threshold,
+                 top_k, nms_threshold, keep_top_k, im_height, im_width):
+    """Detections of a batch from the raw outputs of the net (b x n x ...).
 
-    # keep top-K faster NMS
-    dets = dets[:keep_top_k, :]
-    landms_copy = landms_copy[:keep_top_k, :]
+    Stays in torch on the outputs' device: low scores are dropped before
+    anything is decoded, and NMS runs once for the whole batch with the
+    image id as the category. Returns (image_ids, boxes, landmarks, scores)
+    ordered by image, then by decreasing score.
+    """
+    num_images = conf.shape[0]
+    scores = conf[:, :, 1]
+    image_ids, inds = (scores > confidence_threshold).nonzero(as_tuple=True)
+    scores = scores[image_ids, inds]
+
+    # keep top-K before NMS
+    order = scores.argsort(descending=True)
+    image_ids, inds, scores = image_ids[order], inds[order], scores[order]
+    first = _rank_in_image(image_ids, num_images) < top_k
+    image_ids, inds, scores = image_ids[first], inds[first], scores[first]
 
-    dets = np.concatenate((dets, landms_copy), axis=1)
-    # show image
-    dets = sorted(dets, key=lambda x: x[4], reverse=True)
-    dets = [parse_det(x) for x in dets]
+    priors = prior_data[inds]
+    scale = torch.tensor([im_width, im_height], dtype=priors.dtype, device=priors.device)
+    boxes = decode(loc[image_ids, inds], priors, cfg["variance"]) * scale.repeat(2)
+    landmarks = decode_landm(landms[image_ids, inds], priors, cfg["variance"]) * scale.repeat(5)
 
-    return dets
+    # same IoU as py_cpu_nms, which counts the pixels of both corners
+    nms_boxes = boxes + torch.tensor([0, 0, 1, 1], dtype=boxes.dtype, device=boxes.device)
+    keep = batched_nms(nms_boxes, scores, image_ids, nms_threshold)
+    # keep top-K after NMS, per image in the order of the batch
+    keep = keep[_rank_in_image(image_ids[keep], num_images) < keep_top_k]
+    keep = keep[image_ids[keep].sort(stable=True).indices]
+    return image_ids[keep], boxes[keep], landmarks[keep].view(-1, 5, 2), scores[keep]
 
 
 @torch.no_grad()
@@ -571,107 +564,56 @@ def batch_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5):
     Returns:
 
     """
-    confidence_threshold = threshold
     cfg = cfg_mnet
-    top_k = 5000
-    nms_threshold = 0.4
-    keep_top_k = 750
-    resize = 1
-    # if not is_tensor:
-    #     try:
-    #         img = np.float32(images)
-    #     except ValueError:
-    #         raise NotImplementedError("Input images must of same size")
-    #     img = torch.from_numpy(img)
-    # else:
-    #
     img = images.float()
-    # img = img.to(device)
-    # if cv:
-    # img = img[..., [2, 1, 0]]
     mean = torch.as_tensor([104, 117, 123], dtype=img.dtype, device=img.device).view(
         1, 3, 1, 1
     )
     img -= mean
-    # img = img.permute(0, 3, 1, 2)
-    (
-        _,
-        _,
-        im_height,
-        im_width,
-    ) = img.shape
-    scale = torch.as_tensor(
-        [im_width, im_height, im_width, im_height],
-        dtype=img.dtype,
-        device=img.device,
-    )
-    scale = scale.to(img.device)
+    _, _, im_height, im_width = img.shape
 
     loc, conf, landms = net(img)  # forward pass
 
     priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-    priors = priorbox.forward()
-    prior_data = priors.to(img.device)
-    scale1 = torch.as_tensor(
-        [
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-            img.shape[3],
-            img.shape[2],
-        ],
-        dtype=img.dtype,
-        device=img.device,
-    )
-    scale1 = scale1.to(img.device)
-
-    all_dets = [
-        post_process(
-            loc_i,
-            conf_i,
-            landms_i,
-            prior_data,
-            cfg,
-            scale,
-            scale1,
-            resize,
-            confidence_threshold,
-            top_k,
-            nms_threshold,
-            keep_top_k,
-        )
-        for loc_i, conf_i, landms_i in zip(loc, conf, landms)
-    ]
-
-    # print(all_dets)
-
-    rects = []
-    points = []
-    scores = []
-    image_ids = []
-    for image_id, faces_in_one_image in enumerate(all_dets):
-        for rect, landmarks, score in faces_in_one_image:
-            rects.append(rect)
-            points.append(landmarks)
-            scores.append(score)
-            image_ids.append(image_id)
+    prior_data = priorbox.forward(img.device)
 
+    image_ids, rects, points, scores = post_process(
+        loc, conf, landms, prior_data, cfg,
+        confidence_threshold=threshold, top_k=5000, nms_threshold=0.4, keep_top_k=750,
+        im_height=im_height, im_width=im_width)
     return {
-        'rects': torch.stack(rects, dim=0).to(img.device),
-        'points': torch.stack(points, dim=0).to(img.device),
-        'scores': torch.tensor(scores).to(img.device),
-        'image_ids': torch.tensor(image_ids).to(img.device)
+        'rects': rects,
+        'points': points,
+        'scores': scores,
+        'image_ids': image_ids,
     }
 
 
+def downscaled_detect(net: nn.Module, images: torch.Tensor, threshold: float = 0.5,
+                      max_size: Optional[int] = None):
+    """`batch_detect` on a copy of `images` downscaled so that its long side is
+    at most `max_size`, with rects and points mapped back to `images`."""
+    _, _, h, w = images.shape
+    if not max_size or max(h, w) <= max_size:
+        return batch_detect(net, images, threshold=threshold)
+    scale = max_size / max(h, w)
+    height, width = max(1, round(h * scale)), max(1, round(w * scale))
+    small = F.interpolate(images.float(), size=(height, width), mode='bilinear',
+                          align_corners=False, antialias=True)
+    faces = batch_detect(net, small, threshold=threshold)
+    sx, sy = w / width, h / height
+    faces['rects'] = faces['rects'] * faces['rects'].new_tensor([sx, sy, sx, sy])
+    faces['points'] = faces['points'] * faces['points'].new_tensor([sx, sy])
+    return faces
+
+
 class RetinaFaceDetector(FaceDetector):
     """RetinaFaceDetector
 
+    `conf_name` is the network, optionally with the long side the input is
+    downscaled to before detection: 'mobilenet@640'. Faces are still
+    returned in the coordinates of the input.
+
     Args:
         images (torch.Tensor): b x c x h x w
 
@@ -685,12 +627,15 @@ class RetinaFaceDetector(FaceDetector):
     """
 
     def __init__(self, conf_name: Optional[str] = None,
-                 model_path: Optional[str] = None) -> None:
+                 model_path: Optional[str] = None,
+                 max_size: Optional[int] = None) -> None:
         super().__init__()
         if conf_name is None:
             conf_name = 'mobilenet'
-        self.net = load_net(model_path, conf_name)
+        network, _, size = conf_name.partition('@')
+        self.max_size = max_size or (int(size) if size else None)
+        self.net = load_net(model_path, network)
         self.eval()
 
     def forward(self, images: torch.Tensor) -> Dict[str, torch.Tensor]:
-        return batch_detect(self.net, images, threshold=0.8)
+        return downscaled_detect(self.net, images, threshold=0.8, max_size=self.max_size)
@@ -8,47 +8,84 @@ import cv2
 import numpy as np
 from dotenv import load_dotenv
 import os
+import model_registry
+from metrics import stage
 
 load_dotenv() 
 
 api_key = os.getenv("API_KEY")
 
-# Memory optimization: Image compression and resizing
-def compress_image(image_path, max_size=800, quality=85):
-    """Compress and resize image to reduce memory usage"""
+def load_image(image, max_size=None):
+    """Decode an image into RGB (h x w x 3, uint8).
+
+    `image` can be a file path, the raw bytes of an encoded image or an
+    already decoded RGB ndarray, which is returned as is. With `max_size`,
+    JPEGs are decoded at a reduced scale (1/2, 1/4 or 1/8, done by libjpeg
+    in the DCT domain) that keeps their long side at least `max_size`, which
+    is much cheaper than decoding a phone photo at full resolution. EXIF
+    orientation is applied either way.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        if max_size:
+            img = _load_jpeg_reduced(image, max_size)
+            if img is not None:
+                return img
+        img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        img = cv2.imread(image)
+    if img is None:
+        raise ValueError("Could not decode image")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def _load_jpeg_reduced(data, max_size):
+    """RGB image of JPEG bytes decoded close to `max_size`, or None if not a JPEG"""
+    from PIL import Image, ImageOps
+    import io
+
     try:
-        # Read image
-        img = cv2.imread(image_path)
-        if img is None:
-            return image_path
-        
-        # Get current dimensions
-        height, width = img.shape[:2]
-        
-        # Resize if image is too large
-        if max(height, width) > max_size:
-            scale = max_size / max(height, width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
+        pil_image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise ValueError("Image too large")
+    except OSError:
+        return None
+    if pil_image.format != "JPEG":
+        return None
+
+    # Only reads the header so far: pick the smallest scale that still
+    # covers max_size on the long side
+    width, height = pil_image.size
+    scale = min(1.0, max_size / max(width, height))
+    pil_image.draft("RGB", (max(1, int(width * scale)), max(1, int(height * scale))))
+    try:
+        pil_image = ImageOps.exif_transpose(pil_image)
+        # A writable copy, like the arrays of cv2.imdecode (np.asarray would
+        # be a read-only view of the PIL buffer)
+        return np.array(pil_image.convert("RGB"))
+    except OSError:
+        # Truncated or corrupt data: let OpenCV have a go
+        return None
+
+# Memory optimization: Image resizing, kept in memory
+def compress_image(image, max_size=800):
+    """Decode and downscale an image so that its long side is at most `max_size`"""
+    with stage("decode"):
+        img = load_image(image, max_size=max_size)
+
+    # Get current dimensions
+    height, width = img.shape[:2]
+
+    # Resize if image is too large
+    if max_size and max(height, width) > max_size:
+        scale = max_size / max(height, width)
+        new_width = int(width * scale)
+        new_height = int(height * scale)
+        with stage("compress"):
             img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        
-        # Save compressed image
-        compressed_path = image_path.replace('.jpg', '_compressed.jpg')
-        cv2.imwrite(compressed_path, img, [cv2.IMWRITE_JPEG_QUALITY, quality])
-        
-        return compressed_path
-    except Exception as e:
-        print(f"Compression error: {e}")
-        return image_path
-
-def cleanup_temp_files(*file_paths):
-    """Clean up temporary files to free memory"""
-    for file_path in file_paths:
-        try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            print(f"Cleanup error for {file_path}: {e}")
+
+    return img
 
 # Lazy loading for heavy dependencies
 def _lazy_import_torch():
@@ -124,25 +161,19 @@ def _lazy_import_np():
     return _lazy_import_np._np
 
 
-def get_rgb_codes(path):
-    # Compress image first
-    compressed_path = compress_image(path, max_size=600, quality=80)
-    
+def get_rgb_codes(image):
     torch = _lazy_import_torch()
-    cv2 = _lazy_import_cv2()
     np = _lazy_import_np()
-    import gc
-    
+
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    
+
     # Use lightweight face parser instead of heavy FaRL model
     from lightweight_face_parser import LightweightFaceParser
-    
+
     try:
-        # Read and preprocess image
-        sample = cv2.imread(compressed_path)
-        img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
-        
+        # Decode and downscale in memory
+        img = compress_image(image, max_size=600)
+
         # Convert to tensor format
         image_tensor = torch.from_numpy(img).float().permute(2, 0, 1).unsqueeze(0) / 255.0
         image_tensor = image_tensor.to(device=device)
@@ -181,18 +212,12 @@ def get_rgb_codes(path):
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
-        # Force garbage collection
-        gc.collect()
-        
         return rgb_codes
         
     except Exception as e:
         print(f"Error in get_rgb_codes: {e}")
         # Fallback: return empty array
         return np.array([])
-    finally:
-        # Cleanup compressed file
-        cleanup_temp_files(compressed_path)
 
 def filter_lip_random(rgb_codes,randomNum=40):
     blue_condition = (rgb_codes[:, 2] <= 227)
@@ -237,53 +262,163 @@ def calc_dis(rgb_codes):
     return res
 
 
-def save_skin_mask(img_path):
+def lip_season(rgb_codes):
+    """Season vote of lip pixels against the reference lip colours"""
+    filtered = filter_lip_random(rgb_codes, 40)
+    types = Counter(calc_dis(filtered))
+    if not types:
+        return None
+    return max(types, key=types.get)
+
+
+def dominant_color(pixels):
+    """Dominant colour of an N x 3 array of RGB pixels.
+
+    This used to be a KMeans fit with a single cluster, which always converges
+    to the mean of the pixels, so the mean is taken directly.
+    """
+    with stage("dominant_color"):
+        dominant = np.asarray(pixels, dtype=np.float64).reshape(-1, 3).mean(axis=0).astype(int)
+    dominant_color_rgb = tuple(int(x) for x in dominant)
+    dominant_color_hex = '#%02x%02x%02x' % dominant_color_rgb
+    return {
+        "dominant_color_rgb": dominant_color_rgb,
+        "dominant_color_hex": dominant_color_hex
+    }
+
+
+# RetinaFace subtracts this mean, so padding with it feeds zeros to the net
+DETECTOR_PAD_VALUE = (104, 117, 123)
+# FaRL's warp samples zeros outside a single image, so its batches are padded with black
+PARSER_PAD_VALUE = (0, 0, 0)
+
+
+def _pad_batch(images, torch, value=DETECTOR_PAD_VALUE):
+    """Stack RGB images of different sizes into one b x 3 x H x W tensor,
+    padding at the bottom/right with `value` so pixel coordinates stay unchanged"""
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+    batch = torch.empty((len(images), 3, height, width), dtype=torch.uint8)
+    batch[:] = torch.tensor(value, dtype=torch.uint8).view(1, 3, 1, 1)
+    for i, img in enumerate(images):
+        batch[i, :, :img.shape[0], :img.shape[1]] = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1)
+    return batch
+
+
+def segment_batch(images, detector=None):
+    """Run RetinaFace + FaRL once over a list of RGB images (h x w x 3, uint8).
+
+    The images are padded to a common size and go through one batched
+    detector call and one batched parser call; each model gets the padding
+    that makes a padded image give the same result as the image alone. Only the highest scoring face
+    of each image is parsed. Returns one entry per image: a dict with the
+    per-class probabilities (`probs`, nclasses x h x w numpy array) and
+    `label_names`, or None when no face is detected. `detector` is the conf
+    name of the detector to use (default: `model_registry.DEFAULT_DETECTOR`).
+    """
     torch = _lazy_import_torch()
     facer = _lazy_import_facer()
-    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    image = facer.hwc2bchw(facer.read_hwc(img_path)).to(device=device)  
-    face_detector = facer.face_detector('retinaface/mobilenet', device=device)
 
+    device = model_registry.get_device()
+    if len(images) == 1:
+        image = parser_image = facer.hwc2bchw(torch.from_numpy(np.ascontiguousarray(images[0])))
+    else:
+        image = _pad_batch(images, torch)
+        parser_image = _pad_batch(images, torch, PARSER_PAD_VALUE)
+    image = image.to(device=device)
+    parser_image = parser_image.to(device=device)
+    face_detector = model_registry.get_face_detector(detector or model_registry.DEFAULT_DETECTOR)
+    face_parser = model_registry.get_face_parser()
+
+    results = [None] * len(images)
     with torch.inference_mode():
-      faces = face_detector(image)
+        with stage("retinaface"):
+            faces = face_detector(image)
+
+        # best face of every image that has one
+        best = []
+        for image_id in range(len(images)):
+            candidates = (faces['image_ids'] == image_id).nonzero().view(-1)
+            if candidates.numel() > 0:
+                best.append(candidates[faces['scores'][candidates].argmax()])
+        if not best:
+            return results
+        faces = facer.util.select_data(torch.stack(best), faces)
+
+        with stage("farl"):
+            faces = face_parser(parser_image, faces)
+            faces['seg']['probs'] = faces['seg']['logits'].softmax(dim=1)
+
+    for k, image_id in enumerate(faces['image_ids'].tolist()):
+        face = facer.util.select_data(k, faces)
+        h, w = images[image_id].shape[:2]
+        results[image_id] = {
+            "probs": face['seg']['probs'][:, :h, :w].cpu().numpy(),
+            "label_names": faces['seg']['label_names']
+        }
+    return results
 
-    image = facer.hwc2bchw(facer.read_hwc(img_path)).to(device=device)
-    face_parser = facer.face_parser('farl/lapa/448', device=device)
-    with torch.inference_mode():
-      faces = face_parser(image, faces)
-
-    seg_logits = faces['seg']['logits']
-    seg_probs = seg_logits.softmax(dim=1)
-    seg_probs = seg_probs.cpu() 
-    tensor = seg_probs.permute(0, 2, 3, 1)
-    tensor = tensor.squeeze().numpy()
-
-    face_skin = tensor[:, :, 1]
-    binary_mask = (face_skin >= 0.5).astype(int)
-
-    sample = cv2.imread(img_path)
-    img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
-    masked_image = np.zeros_like(img) 
-    try: 
-      masked_image[binary_mask == 1] = img[binary_mask == 1] 
-      masked_image = cv2.cvtColor(masked_image,cv2.COLOR_BGR2RGB)
-      cv2.imwrite("temp.jpg" , masked_image)
-    except:
+
+def segment_face(img, detector=None):
+    """Run RetinaFace + FaRL once on an RGB image (h x w x 3, uint8).
+
+    Only the highest scoring face is parsed. Returns a dict with the per-class
+    probabilities (`probs`, nclasses x h x w numpy array) and `label_names`,
+    or None when no face is detected.
+    """
+    return segment_batch([img], detector)[0]
+
+
+def region_mask(segmentation, *label_names, threshold=0.5):
+    """Binary mask of the union of the given FaRL classes"""
+    names = segmentation["label_names"]
+    probs = sum(segmentation["probs"][names.index(name)] for name in label_names)
+    return probs >= threshold
+
+
+def skin_mask_image(img, segmentation):
+    """RGB image with everything but the face skin blacked out"""
+    mask = region_mask(segmentation, 'face')
+    masked_image = np.zeros_like(img)
+    masked_image[mask] = img[mask]
+    return masked_image
+
+
+def get_skin_mask(image):
+    """Skin-only RGB image of a path, bytes or RGB ndarray (None if no face)"""
+    img = load_image(image)
+    segmentation = segment_face(img)
+    if segmentation is None:
+        return None
+    return skin_mask_image(img, segmentation)
+
+
+def save_skin_mask(image, out_path="temp.jpg"):
+    """Write the skin-only image to `out_path` (for debugging, the API stays in memory)"""
+    masked_image = get_skin_mask(image)
+    if masked_image is None:
       print("error occurred")
+      return
+    cv2.imwrite(out_path, cv2.cvtColor(masked_image, cv2.COLOR_RGB2BGR))
 
 
-def get_eye_color(image_path):
+def get_eye_color(image):
+    return eye_color_from_image(cv2.cvtColor(load_image(image), cv2.COLOR_RGB2BGR))
+
+
+def eye_color_from_image(image):
+    """Eye colour from a BGR image using the MediaPipe iris landmarks"""
     mp = _lazy_import_mediapipe()
     cv2 = _lazy_import_cv2()
     np = _lazy_import_np()
     stats = _lazy_import_scipy()
 
     mp_face_mesh = mp.solutions.face_mesh
-    face_mesh = mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True)
-    image = cv2.imread(image_path)
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    results = face_mesh.process(rgb_image)
+    with stage("mediapipe"):
+        face_mesh = mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, refine_landmarks=True)
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        results = face_mesh.process(rgb_image)
+        face_mesh.close()
 
     LEFT_IRIS = [468, 469, 470, 471]
 
@@ -345,138 +480,45 @@ def get_eye_color(image_path):
         return None
 
 
-def analyze_lip_color(image_path):
-    rgb_codes = get_rgb_codes(image_path)
+def lip_color_from_pixels(rgb_codes):
+    """Dominant lip colour and its season vote"""
     if rgb_codes is None or len(rgb_codes) == 0:
         return {"error": "No lip region detected"}
+    result = dominant_color(rgb_codes)
+    result["season"] = lip_season(rgb_codes)
+    return result
 
-    # k-means for dominant color
-    try:
-        from sklearn.cluster import KMeans
-    except ImportError:
-        raise ImportError("scikit-learn is required for k-means clustering. Please add it to requirements.txt.")
-    kmeans = KMeans(n_clusters=1, random_state=42).fit(rgb_codes)
-    dominant_color = kmeans.cluster_centers_[0].astype(int)
-    # Converting to Python int for JSON serialization
-    dominant_color_rgb = tuple(int(x) for x in dominant_color)
-    dominant_color_hex = '#%02x%02x%02x' % dominant_color_rgb
-
-    # Seasonal classification
-    filtered = filter_lip_random(rgb_codes, 40)
-    types = Counter(calc_dis(filtered))
-    season = max(types, key=types.get)
 
-    return {
-        "dominant_color_rgb": dominant_color_rgb,
-        "dominant_color_hex": dominant_color_hex,
-        "season": season
-    }
+def analyze_lip_color(image):
+    return lip_color_from_pixels(get_rgb_codes(image))
 
 
-def analyze_skin_color(image_path):
-    torch = _lazy_import_torch()
-    facer = _lazy_import_facer()
-    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    image = facer.hwc2bchw(facer.read_hwc(image_path)).to(device=device)
-    face_detector = facer.face_detector('retinaface/mobilenet', device=device)
-    with torch.inference_mode():
-        faces = face_detector(image)
-    face_parser = facer.face_parser('farl/lapa/448', device=device)
-    with torch.inference_mode():
-        faces = face_parser(image, faces)
-    seg_logits = faces['seg']['logits']
-    seg_probs = seg_logits.softmax(dim=1)
-    seg_probs = seg_probs.cpu()
-    tensor = seg_probs.permute(0, 2, 3, 1)
-    tensor = tensor.squeeze().numpy()
-    face_skin = tensor[:, :, 1]
-    binary_mask = (face_skin >= 0.5).astype(int)
-    sample = cv2.imread(image_path)
-    img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
-    skin_pixels = img[binary_mask == 1]
-    if skin_pixels is None or len(skin_pixels) == 0:
+def analyze_skin_color(image):
+    img = load_image(image)
+    segmentation = segment_face(img)
+    if segmentation is None:
+        return {"error": "No face detected"}
+    skin_pixels = img[region_mask(segmentation, 'face')]
+    if len(skin_pixels) == 0:
         return {"error": "No skin region detected"}
-    try:
-        from sklearn.cluster import KMeans
-    except ImportError:
-        raise ImportError("scikit-learn is required for k-means clustering. Please add it to requirements.txt.")
-    kmeans = KMeans(n_clusters=1, random_state=42).fit(skin_pixels)
-    dominant_color = kmeans.cluster_centers_[0].astype(int)
-    dominant_color_rgb = tuple(int(x) for x in dominant_color)
-    dominant_color_hex = '#%02x%02x%02x' % dominant_color_rgb
-    return {
-        "dominant_color_rgb": dominant_color_rgb,
-        "dominant_color_hex": dominant_color_hex
-    }
+    return dominant_color(skin_pixels)
 
 
-def analyze_hair_color(image_path):
-    torch = _lazy_import_torch()
-    facer = _lazy_import_facer()
-    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    image = facer.hwc2bchw(facer.read_hwc(image_path)).to(device=device)
-    face_detector = facer.face_detector('retinaface/mobilenet', device=device)
-    with torch.inference_mode():
-        faces = face_detector(image)
-    face_parser = facer.face_parser('farl/lapa/448', device=device)
-    with torch.inference_mode():
-        faces = face_parser(image, faces)
-    seg_logits = faces['seg']['logits']
-    seg_probs = seg_logits.softmax(dim=1)
-    seg_probs = seg_probs.cpu()
-    tensor = seg_probs.permute(0, 2, 3, 1)
-    tensor = tensor.squeeze().numpy()
-    print('Segmentation tensor shape:', tensor.shape)
-    num_classes = tensor.shape[2] if tensor.ndim == 3 else 0
-    print('Number of available classes:', num_classes)
-    # Accessing all classes and printing their mean mask value
-    for idx in range(num_classes):
-        mask = tensor[:, :, idx]
-        print(f'Class {idx} mean mask value:', mask.mean())
-    # trying the last class as a guess for hair
-    hair_mask = tensor[:, :, -1]
-    binary_mask = (hair_mask >= 0.5).astype(int)
-    sample = cv2.imread(image_path)
-    img = cv2.cvtColor(sample, cv2.COLOR_BGR2RGB)
-    hair_pixels = img[binary_mask == 1]
-    if hair_pixels is None or len(hair_pixels) == 0:
+def analyze_hair_color(image):
+    img = load_image(image)
+    segmentation = segment_face(img)
+    if segmentation is None:
+        return {"error": "No face detected"}
+    hair_pixels = img[region_mask(segmentation, 'hair')]
+    if len(hair_pixels) == 0:
         return {"error": "No hair region detected"}
-    try:
-        from sklearn.cluster import KMeans
-    except ImportError:
-        raise ImportError("scikit-learn is required for k-means clustering. Please add it to requirements.txt.")
-    kmeans = KMeans(n_clusters=1, random_state=42).fit(hair_pixels)
-    dominant_color = kmeans.cluster_centers_[0].astype(int)
-    dominant_color_rgb = tuple(int(x) for x in dominant_color)
-    dominant_color_hex = '#%02x%02x%02x' % dominant_color_rgb
-    return {
-        "dominant_color_rgb": dominant_color_rgb,
-        "dominant_color_hex": dominant_color_hex
-    }
-
-    import requests
-
-    def get_palette_from_llm(prompt, api_key):
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "model": "mistralai/mistral-small-3.2-24b-instruct:free",  
-            "messages": [{"role": "user", "content": prompt}]
-        }
-        response = requests.post(url, headers=headers, json=data)
-        print("OpenRouter response:", response.status_code, response.text)  
-        return response.json()
+    return dominant_color(hair_pixels)
 
 
-def get_style_recommendation_from_llm(answers, api_key):
+def build_style_recommendation_prompt(answers):
     """
     Given a dict of answers (with keys: dressing_focus, gender, body_type, context_answer),
-    build a prompt, call OpenRouter, and return the suggestion string.
+    build the style recommendation prompt.
     """
     dressing_focus = answers.get("dressing_focus", "")
     gender = answers.get("gender", "")
@@ -507,9 +549,12 @@ Return as JSON array only:
   ...
 ]
 """
-    llm_response = get_palette_from_llm(prompt, api_key)
-    try:
-        suggestion = llm_response['choices'][0]['message']['content']
-    except Exception as e:
-        suggestion = str(llm_response)
-    return suggestion
\ No newline at end of file
+    return prompt
+
+
+async def get_style_recommendation_from_llm(answers, api_key):
+    """
+    Build the style prompt from the answers, call OpenRouter, and return the suggestion string.
+    """
+    from llm_client import llm
+    return await llm.complete(build_style_recommendation_prompt(answers), api_key)
@@ -0,0 +1,109 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+import profiling
+
+
+class ExecutorBusy(RuntimeError):
+    """Raised when the inference queue is full; the caller should retry later"""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+def _timed_call(submitted, fn, *args, **kwargs):
+    metrics.record_stage("queue_wait", time.perf_counter() - submitted)
+    return profiling.run_profiled(fn, *args, **kwargs)
+
+
+def _process_call(submitted, profile, fn, *args, **kwargs):
+    """Job of a worker process: the result of `fn`, with the stage timings
+    and profile stats it collected for the parent to record"""
+    with metrics.collect_stages() as timings:
+        # Wall clock: perf_counter isn't comparable across processes everywhere
+        metrics.record_stage("queue_wait", time.time() - submitted)
+        result, stats = profiling.profile_stats(profile, fn, *args, **kwargs)
+    return result, timings, stats
+
+
+class InferenceExecutor:
+    """Runs blocking inference off the event loop with bounded concurrency.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait
+    for a worker; anything beyond that is rejected right away with
+    `ExecutorBusy` instead of piling up. `kind` is "thread" (default, models
+    shared by all workers) or "process" (one copy of the models per worker,
+    `fn` and its arguments must be picklable). `initializer` is run by every
+    worker process when it starts, before its first job. The stage timings
+    and the `?profile=1` stats of a job in a worker process are sent back with
+    its result and recorded for the request like those of a thread.
+
+    The pending counter is only touched from the event loop thread, so it
+    needs no lock.
+    """
+
+    def __init__(self, max_workers=None, max_queue=None, kind=None, retry_after=None, initializer=None):
+        self.max_workers = max_workers or int(os.getenv("INFERENCE_WORKERS", "2"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("INFERENCE_QUEUE_SIZE", "8"))
+        self.kind = kind or os.getenv("INFERENCE_EXECUTOR", "thread")
+        self.retry_after = retry_after or int(os.getenv("INFERENCE_RETRY_AFTER", "5"))
+        if self.kind not in ("thread", "process"):
+            raise ValueError(f"Unknown executor kind: {self.kind}")
+        self.initializer = initializer
+        self._pool = None
+        self._pending = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            if self.kind == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix="inference")
+        return self._pool
+
+    async def run(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` on the pool and await its result"""
+        if self._pending >= self.max_workers + self.max_queue:
+            raise ExecutorBusy(self.retry_after)
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            if self.kind == "thread":
+                # Carry the request's context variables into the worker thread
+                call = functools.partial(contextvars.copy_context().run, _timed_call,
+                                         time.perf_counter(), fn, *args, **kwargs)
+                return await loop.run_in_executor(self._get_pool(), call)
+            # Context variables don't cross processes: record here what the job collected
+            call = functools.partial(_process_call, time.time(), profiling.profiling(), fn, *args, **kwargs)
+            result, timings, stats = await loop.run_in_executor(self._get_pool(), call)
+            metrics.record_stages(timings)
+            profiling.add_stats(stats)
+            return result
+        finally:
+            self._pending -= 1
+
+    def stats(self):
+        running = min(self._pending, self.max_workers)
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "queue_size": self.max_queue,
+            "running": running,
+            "queued": self._pending - running,
+        }
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
+
+
+executor = InferenceExecutor()
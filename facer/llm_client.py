@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+
+import metrics
+
+DEFAULT_BASE_URL = "https://openrouter.ai/api/v1"
+DEFAULT_MODEL = "mistralai/mistral-small-3.2-24b-instruct:free"
+
+# Statuses worth retrying: rate limiting and transient upstream failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMError(RuntimeError):
+    """The LLM API answered a streaming request with an error status"""
+
+    def __init__(self, status_code, body):
+        super().__init__(f"LLM API error {status_code}: {body}")
+        self.status_code = status_code
+
+
+def response_content(llm_response):
+    """Text of the first choice, or the raw response if there is none"""
+    try:
+        return llm_response['choices'][0]['message']['content']
+    except Exception:
+        return str(llm_response)
+
+
+def finished_normally(llm_response):
+    """Whether a chat completion has content and finished normally (a finish
+    reason other than "error"), rather than being cut off or failing"""
+    try:
+        choice = llm_response['choices'][0]
+        return bool(choice['message']['content']) and choice.get('finish_reason') not in (None, "error")
+    except (KeyError, IndexError, TypeError):
+        return False
+
+
+class OpenRouterClient:
+    """Async OpenRouter chat client.
+
+    Connections are pooled in one `httpx.AsyncClient`, requests have
+    connect/read timeouts and failed calls (transport errors, 429 and 5xx) are
+    retried with exponential backoff and jitter. Successful responses are
+    cached on (model, prompt hash), so an identical prompt is answered locally.
+    Point `base_url` (or OPENROUTER_BASE_URL) at `stub_servers.openrouter_app`
+    to run without the real API.
+    """
+
+    def __init__(self, base_url=None, model=None, timeout=None, connect_timeout=None,
+                 max_retries=None, backoff=None, max_connections=None,
+                 cache_size=None, cache_ttl=None):
+        self.base_url = (base_url or os.getenv("OPENROUTER_BASE_URL", DEFAULT_BASE_URL)).rstrip("/")
+        self.model = model or os.getenv("OPENROUTER_MODEL", DEFAULT_MODEL)
+        self.timeout = httpx.Timeout(
+            timeout or float(os.getenv("LLM_TIMEOUT", "60")),
+            connect=connect_timeout or float(os.getenv("LLM_CONNECT_TIMEOUT", "10")))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLM_MAX_RETRIES", "2"))
+        self.backoff = backoff if backoff is not None else float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+        self.limits = httpx.Limits(
+            max_connections=max_connections or int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=10)
+        self.cache_size = cache_size if cache_size is not None else int(os.getenv("LLM_CACHE_SIZE", "512"))
+        self.cache_ttl = cache_ttl if cache_ttl is not None else float(os.getenv("LLM_CACHE_TTL", "86400"))
+
+        self._client = None
+        self._loop = None
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _get_client(self):
+        # An AsyncClient is bound to the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    @staticmethod
+    def cache_key(model, prompt):
+        return model, hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            hit = entry is not None and entry[0] > time.time()
+            metrics.record_cache_lookup("llm", hit)
+            if hit:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+            return None
+
+    def _cache_put(self, key, value):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = (time.time() + self.cache_ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _retry_delay(self, attempt):
+        return self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+
+    async def chat(self, prompt, api_key, model=None, use_cache=True):
+        """Send a single-message chat completion and return the response JSON"""
+        model = model or self.model
+        key = self.cache_key(model, prompt)
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+
+        client = self._get_client()
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}]
+        }
+
+        with metrics.stage("llm"):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await client.post("/chat/completions", headers=headers, json=data)
+                except httpx.TransportError:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self._retry_delay(attempt))
+                    continue
+                if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                    await asyncio.sleep(self._retry_delay(attempt))
+                    continue
+                break
+
+        try:
+            llm_response = response.json()
+        except ValueError:
+            llm_response = {"error": response.text, "status_code": response.status_code}
+
+        if response.status_code == 200 and finished_normally(llm_response):
+            self._cache_put(key, llm_response)
+        return llm_response
+
+    async def stream(self, prompt, api_key, model=None, use_cache=True, on_complete=None):
+        """Yield the completion text in chunks as the API streams it (SSE).
+
+        A cached response is yielded as one chunk. Connection errors, 429 and
+        5xx are retried like `chat` as long as nothing has been yielded yet;
+        any other error status raises `LLMError`. When the completion isn't
+        empty and finished normally (a finish reason other than "error" was
+        sent), it is cached, so a later `chat` with the same prompt hits the
+        cache, and `on_complete(content)` is called with it.
+        """
+        model = model or self.model
+        key = self.cache_key(model, prompt)
+        if use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                content = response_content(cached)
+                yield content
+                if on_complete is not None:
+                    on_complete(content)
+                return
+
+        client = self._get_client()
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        data = {
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True
+        }
+
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                request = client.build_request("POST", "/chat/completions", headers=headers, json=data)
+                response = await client.send(request, stream=True)
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                await response.aclose()
+                await asyncio.sleep(self._retry_delay(attempt))
+                continue
+            break
+
+        parts = []
+        finish_reason = None
+        try:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise LLMError(response.status_code, body.decode("utf-8", "replace"))
+            async for line in response.aiter_lines():
+                # Skip keep-alive comments (": OPENROUTER PROCESSING") and blank lines
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(payload)
+                except ValueError:
+                    continue
+                choices = chunk.get("choices") or [{}]
+                finish_reason = choices[0].get("finish_reason") or finish_reason
+                text = (choices[0].get("delta") or {}).get("content")
+                if text:
+                    parts.append(text)
+                    yield text
+        finally:
+            await response.aclose()
+            metrics.record_stage("llm", time.perf_counter() - start)
+
+        llm_response = {"choices": [{"message": {"role": "assistant", "content": "".join(parts)},
+                                     "finish_reason": finish_reason}]}
+        # A stream cut off upstream or an empty choice would be served to
+        # every later identical prompt until the TTL expires
+        if finished_normally(llm_response):
+            self._cache_put(key, llm_response)
+            if on_complete is not None:
+                on_complete(response_content(llm_response))
+
+    async def complete(self, prompt, api_key, model=None):
+        """Text of the completion (falls back to the raw response, like before)"""
+        return response_content(await self.chat(prompt, api_key, model=model))
+
+    def stats(self):
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            "cache_entries": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": round(self.cache_hits / lookups, 3) if lookups else 0.0,
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+llm = OpenRouterClient()
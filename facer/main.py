@@ -7,13 +7,36 @@ import numpy as np
 import os
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi import FastAPI, File, UploadFile
+import asyncio
 import base64
+import copy
+import hashlib
+import time
+import json
+import shutil
+import tempfile
+import zipfile
+from typing import List
 import skin_model as m
-import requests
+import model_registry
+from pipeline import pipeline, normalize_season, ALL_FEATURES, SEASON_NAMES
+from inference_executor import executor, ExecutorBusy
+from result_cache import cache
+from llm_client import llm
+from serpapi_client import serpapi
+from singleflight import SingleFlight
+from quiz import build_quiz_palette_prompt, normalize_quiz_answers, quiz_memo
+from streaming import sse_event, palette_events
+from batching import scheduler
+import warmup
+import metrics
+from metrics import MetricsMiddleware
+from profiling import ProfilingMiddleware
 import re
 from fastapi import Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi import Form
 from fastapi import Body
 import logging
@@ -22,122 +45,204 @@ import traceback
 
 # Memory monitoring
 try:
-    from memory_monitor import log_memory_usage, optimize_memory, check_memory_limit
+    from memory_monitor import get_memory_usage, log_memory_usage, admission, AdmissionMiddleware
     MEMORY_MONITORING = True
 except ImportError:
     MEMORY_MONITORING = False
     def log_memory_usage(stage=""): pass
-    def optimize_memory(): pass
-    def check_memory_limit(limit_mb=500): return True
+    def get_memory_usage(): return 0.0
 
 app = FastAPI()
 logger = logging.getLogger("uvicorn.error")
 
-# Memory optimization: Image compression
-def compress_uploaded_image(content, max_size=800, quality=85):
-    """Compress uploaded image to reduce memory usage"""
-    try:
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(content, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            return content
-        
-        # Get current dimensions
-        height, width = img.shape[:2]
-        
-        # Resize if image is too large
-        if max(height, width) > max_size:
-            scale = max_size / max(height, width)
-            new_width = int(width * scale)
-            new_height = int(height * scale)
-            img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        
-        # Encode back to bytes with compression
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-        _, compressed_content = cv2.imencode('.jpg', img, encode_param)
-        
-        return compressed_content.tobytes()
-    except Exception as e:
-        print(f"Compression error: {e}")
-        return content
-
 # Get frontend URL from environment variable
 frontend_url = os.getenv("VITE_FRONTEND_URL")
 print("Frontend URL for CORS:", frontend_url)
+app.add_middleware(ProfilingMiddleware)
+if MEMORY_MONITORING:
+    # Queue or reject requests before they can push the worker into an OOM kill
+    app.add_middleware(AdmissionMiddleware, controller=admission)
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], 
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the frontend read per-request stage timings
+    expose_headers=["Server-Timing"],
 )
-SERPAPI_KEY = os.getenv("SERPAPI_KEY")
 @app.get("/")
 async def root():
     return {"message": "Colorinsight Personal Color Analysis API", "endpoints": ["/image", "/lip"], "docs": "/docs"}
 
 
-
-@app.post("/image")
-async def image(file: UploadFile = File(None)):
-    # 1) Early 400 if no file
+@app.get("/models")
+async def models():
+    # Load time and memory of each model loaded by this worker
+    return {"device": model_registry.get_device(), "models": model_registry.registry.stats()}
+
+
+@app.get("/cache")
+async def cache_stats():
+    # Hit/miss counters of the feature cache and quiz memo of this worker
+    return {**cache.stats(), "uploads": upload_flights.stats(), "quiz": quiz_memo.stats(), "serpapi": serpapi.stats()}
+
+def collect_metrics():
+    # Point-in-time gauges added to /metrics
+    executor_stats = executor.stats()
+    batch_stats = scheduler.stats()
+    caches = {"features": cache.stats(), "llm": llm.stats(), "quiz": quiz_memo.stats(), "serpapi": serpapi.stats()}
+    gauges = [
+        ("facer_inference_running", "Inference jobs running", [({}, executor_stats["running"])]),
+        ("facer_inference_queue_depth", "Inference jobs waiting for a worker", [({}, executor_stats["queued"])]),
+        ("facer_batch_queue_depth", "Images waiting for a segmentation batch", [({}, batch_stats["queued"])]),
+        ("facer_batch_size_avg", "Average segmentation batch size", [({}, batch_stats["avg_batch_size"])]),
+        ("facer_shared_uploads", "Requests that joined an identical upload already in flight, since start",
+         [({}, upload_flights.shared)]),
+        ("facer_cache_hit_ratio", "Hit rate of each cache since start",
+         [({"cache": name}, stats.get("hit_rate", stats.get("cache_hit_rate", 0.0))) for name, stats in caches.items()]),
+        ("facer_model_load_seconds", "Time it took to load each model",
+         [({"model": name}, stats["load_time_s"]) for name, stats in model_registry.registry.stats().items()]),
+        ("facer_model_rss_delta_megabytes", "RSS growth while loading each model",
+         [({"model": name}, stats["rss_delta_mb"]) for name, stats in model_registry.registry.stats().items()]),
+    ]
+    if MEMORY_MONITORING:
+        memory = admission.stats()
+        gauges += [
+            ("facer_resident_memory_megabytes", "RSS of this worker", [({}, round(get_memory_usage(), 2))]),
+            ("facer_memory_headroom_megabytes", "Memory left for new requests", [({}, memory["headroom_mb"])]),
+            ("facer_admission_waiting", "Requests waiting for memory", [({}, memory["waiting"])]),
+            ("facer_admission_rejected", "Requests rejected for lack of memory since start", [({}, memory["rejected"])]),
+            ("facer_memory_estimate_megabytes", "Peak memory estimate per request",
+             [({"endpoint": name}, mb) for name, mb in memory["estimates_mb"].items()]),
+        ]
+    return gauges
+
+metrics.register_collector(collect_metrics)
+
+@app.get("/memory")
+async def memory():
+    # Memory limit, current RSS and the headroom left for new requests
+    if not MEMORY_MONITORING:
+        return {"error": "Memory monitoring is not available"}
+    return admission.stats()
+
+@app.on_event("startup")
+async def start_memory_sampler():
+    if MEMORY_MONITORING:
+        admission.start()
+
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1") != "0"
+
+async def preload_models():
+    # Warm up on the inference executor, where requests will run. Worker
+    # processes warm themselves up in their initializer (a job isn't sure to
+    # reach every process), so their first job waits for it
+    start = time.perf_counter()
+    try:
+        if executor.kind == "process":
+            steps = await executor.run(warmup.worker_steps)
+        else:
+            steps = await executor.run(warmup.warm_up)
+        warmup.state["steps"] = steps
+        warmup.state["ready"] = True
+        print(f"Models preloaded and warmed up in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        # Stay not ready: a worker that can't run the models shouldn't get traffic
+        warmup.state["error"] = str(e)
+        logger.exception(" Model warm-up failed")
+    warmup.state["seconds"] = round(time.perf_counter() - start, 3)
+
+if PRELOAD_MODELS:
+    executor.initializer = warmup.warm_up_worker
+
+@app.on_event("startup")
+async def start_preloading():
+    if PRELOAD_MODELS:
+        app.state.preload_task = asyncio.create_task(preload_models())
+    else:
+        warmup.state["ready"] = True
+
+@app.get("/ready")
+async def ready():
+    # Readiness probe: 200 only once the models are loaded and warmed up
+    return JSONResponse(status_code=200 if warmup.state["ready"] else 503, content=warmup.state)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus text format: per-stage latency histograms by endpoint plus the gauges above
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.on_event("shutdown")
+async def shutdown_clients():
+    executor.shutdown(wait=False)
+    await llm.aclose()
+    await serpapi.aclose()
+
+
+async def read_upload(file):
+    """Read the uploaded image bytes, 400 if there is no file"""
     if not file or not file.filename:
         raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
+    logger.info(f"🔹 Received file: {file.filename}")
+    return await file.read()
+
 
+async def run_inference(fn, *args):
+    """Run blocking model code on the inference executor, 503 when it is saturated"""
     try:
-        log_memory_usage("at start")
-        logger.info(f"🔹 Received file: {file.filename}")
+        return await executor.run(fn, *args)
+    except ExecutorBusy as e:
+        raise HTTPException(status_code=503, detail="Server busy, please retry.",
+                            headers={"Retry-After": str(e.retry_after)})
 
-        # 2) Read & compress
-        content = await file.read()
-        compressed_content = compress_uploaded_image(content, max_size=600, quality=80)
-        with open("saved.jpg", "wb") as fi:
-            fi.write(compressed_content)
 
-        gc.collect()
-        log_memory_usage("after compression")
+# Identical uploads in flight at the same time (client retries, the frontend
+# calling /image and /analyze_features with the same file) share one run
+upload_flights = SingleFlight()
 
-        # 3) Eye-color
-        eye_color = f.get_eye_color("saved.jpg")
-        log_memory_usage("after eye color analysis")
+def quality_detector(quality):
+    """Detector conf name for the `quality` query parameter, 400 if unknown"""
+    if quality not in model_registry.QUALITIES:
+        raise HTTPException(status_code=400,
+                            detail=f"quality must be one of: {', '.join(model_registry.QUALITIES)}")
+    return model_registry.detector_name(quality)
 
-        # 4) Skin mask → temp.jpg
-        f.save_skin_mask("saved.jpg")
-        if not os.path.exists("temp.jpg"):
-            raise HTTPException(status_code=500, detail="Skin-mask step failed to produce temp.jpg")
-        log_memory_usage("after skin mask")
 
-        # 5) Season classification
-        try:
-            ans = m.get_season("temp.jpg")
-        except Exception:
-            logger.exception(" Error during skin-model inference")
-            raise HTTPException(status_code=500, detail="Skin model inference failed.")
-        log_memory_usage("after season analysis")
-
-        # 6) Cleanup
-        for fn in ("temp.jpg", "saved.jpg"):
-            try: os.remove(fn)
-            except OSError: pass
-
-        gc.collect()
-        optimize_memory()
-        check_memory_limit(500)
-
-        # 7) Normalize & return
-        if ans == 3:
-            ans += 1
-        elif ans == 0:
-            ans = 3
-        season_names = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
+async def extract_features(content, features=ALL_FEATURES, quality="full"):
+    """Run the single-pass feature pipeline, 400 if the upload is not an image.
 
+    quality=fast detects faces on a downscaled copy of the image (selfies).
+    """
+    detector = quality_detector(quality)
+    key = (hashlib.sha256(content).hexdigest(), tuple(sorted(features)), detector)
+    try:
+        result = await upload_flights.do(key, run_inference, pipeline.extract, content, features, detector)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Every caller gets the same object from a shared run
+    return copy.deepcopy(result)
+
+
+@app.post("/image")
+async def image(file: UploadFile = File(None), quality: str = Query("full")):
+    content = await read_upload(file)
+
+    try:
+        log_memory_usage("at start")
+        result = await extract_features(content, quality=quality)
+        log_memory_usage("after feature extraction")
+
+        if result["season"] is None:
+            raise HTTPException(status_code=400, detail="No face detected")
+
+        ans = normalize_season(result["season"])
         return JSONResponse({
             "message": "complete",
             "result": ans,
-            "season": season_names.get(ans, "Unknown"),
-            "eye_color": eye_color
+            "season": SEASON_NAMES.get(ans, "Unknown"),
+            "eye_color": result["eyes"]
         })
 
     except HTTPException:
@@ -152,17 +257,10 @@ async def image(file: UploadFile = File(None)):
 @app.post("/lip")
 async def lip(file: UploadFile = File(None)):
     try:
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
+        content = await read_upload(file)
 
         # lip color analysis function
-        result = f.analyze_lip_color("saved.jpg")
-        os.remove("saved.jpg")
+        result = await run_inference(f.analyze_lip_color, content)
 
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
@@ -173,23 +271,18 @@ async def lip(file: UploadFile = File(None)):
             "dominant_color_hex": result["dominant_color_hex"],
             "season": result["season"]
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
 @app.post("/skin")
-async def skin(file: UploadFile = File(None)):
+async def skin(file: UploadFile = File(None), quality: str = Query("full")):
     try:
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
+        content = await read_upload(file)
 
-        result = f.analyze_skin_color("saved.jpg")
-        os.remove("saved.jpg")
+        result = (await extract_features(content, ("skin",), quality))["skin"]
 
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
@@ -199,23 +292,18 @@ async def skin(file: UploadFile = File(None)):
             "dominant_skin_color_rgb": result["dominant_color_rgb"],
             "dominant_skin_color_hex": result["dominant_color_hex"]
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
 @app.post("/hair")
-async def hair(file: UploadFile = File(None)):
+async def hair(file: UploadFile = File(None), quality: str = Query("full")):
     try:
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
+        content = await read_upload(file)
 
-        result = f.analyze_hair_color("saved.jpg")
-        os.remove("saved.jpg")
+        result = (await extract_features(content, ("hair",), quality))["hair"]
 
         if "error" in result:
             raise HTTPException(status_code=400, detail=result["error"])
@@ -225,6 +313,8 @@ async def hair(file: UploadFile = File(None)):
             "dominant_hair_color_rgb": result["dominant_color_rgb"],
             "dominant_hair_color_hex": result["dominant_color_hex"]
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -232,23 +322,16 @@ async def hair(file: UploadFile = File(None)):
 @app.post("/eye")
 async def eye(file: UploadFile = File(None)):
     try:
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
+        content = await read_upload(file)
 
-        result = f.get_eye_color("saved.jpg")
-        os.remove("saved.jpg")
+        result = (await extract_features(content, ("eyes",)))["eyes"]
 
         if result is None:
             raise HTTPException(status_code=400, detail="No eye region detected")
 
         rgb = result["rgb"]
         color_name = result["color"]
-        hex_color = '#%02x%02x%02x' % rgb
+        hex_color = '#%02x%02x%02x' % tuple(rgb)
 
         return JSONResponse(content={
             "message": "complete",
@@ -256,40 +339,127 @@ async def eye(file: UploadFile = File(None)):
             "dominant_eye_color_hex": hex_color,
             "dominant_eye_color_name": color_name
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
 @app.post("/analyze_features")
-async def analyze_features(file: UploadFile = File(None)):
+async def analyze_features(file: UploadFile = File(None), quality: str = Query("full")):
+    content = await read_upload(file)
     try:
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
-
-        # feature extraction functions for all features
-        skin = f.analyze_skin_color("saved.jpg")
-        hair = f.analyze_hair_color("saved.jpg")
-        lips = f.analyze_lip_color("saved.jpg")
-        eyes = f.get_eye_color("saved.jpg")
-        os.remove("saved.jpg")
+        result = await extract_features(content, quality=quality)
+        season = normalize_season(result["season"])
 
-        
         return JSONResponse(content={
             "message": "complete",
-            "skin": skin,
-            "hair": hair,
-            "lips": lips,
-            "eyes": eyes
+            "skin": result["skin"],
+            "hair": result["hair"],
+            "lips": result["lips"],
+            "eyes": result["eyes"],
+            "season": SEASON_NAMES.get(season)
         })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
+BATCH_SIZE = int(os.getenv("BATCH_ANALYZE_SIZE", "8"))
+BATCH_MAX_IMAGE_BYTES = int(os.getenv("BATCH_MAX_IMAGE_MB", "20")) * 1024 * 1024
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+def is_zip_upload(file):
+    return (file.content_type in ("application/zip", "application/x-zip-compressed")
+            or (file.filename or "").lower().endswith(".zip"))
+
+def spool_upload(upload):
+    """Copy an upload to a real temporary file (zipfile needs `seekable`,
+    which SpooledTemporaryFile lacks before Python 3.11)"""
+    spool = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload, spool)
+    return spool
+
+async def iter_batch_uploads(files):
+    """(name, bytes or error) of every image in the uploads, reading one at a time.
+
+    Zip archives are expanded member by member, so only the image being read
+    is held in memory. All file I/O runs in the thread pool, so a large batch
+    doesn't block the event loop.
+    """
+    for file in files:
+        if not is_zip_upload(file):
+            yield file.filename, await file.read()
+            continue
+        spool = await run_in_threadpool(spool_upload, file.file)
+        try:
+            try:
+                archive = await run_in_threadpool(zipfile.ZipFile, spool)
+            except zipfile.BadZipFile:
+                yield file.filename, ValueError("Not a valid zip archive")
+                continue
+            async for item in iter_zip_images(archive):
+                yield item
+        finally:
+            await run_in_threadpool(spool.close)
+
+async def iter_zip_images(archive):
+    with archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            if info.file_size > BATCH_MAX_IMAGE_BYTES:
+                yield info.filename, ValueError("Image too large")
+                continue
+            yield info.filename, await run_in_threadpool(archive.read, info)
+
+def batch_result_line(index, name, result):
+    if "error" not in result:
+        result["season"] = SEASON_NAMES.get(normalize_season(result["season"]))
+    return json.dumps({"index": index, "filename": name, **result}) + "\n"
+
+@app.post("/batch/analyze")
+async def batch_analyze(files: List[UploadFile] = File(...), batch_size: int = Query(None),
+                        quality: str = Query("full")):
+    # Analyze many images (a multipart list and/or zip archives) and stream one
+    # NDJSON line per image as soon as its batch is done. Images go through
+    # RetinaFace + FaRL `batch_size` at a time, so memory stays bounded by one
+    # batch however many images are sent.
+    batch_size = max(1, min(batch_size or BATCH_SIZE, 64))
+    detector = quality_detector(quality)
+
+    async def run_batch(batch):
+        contents = [content for _, _, content in batch]
+        try:
+            results = await run_inference(pipeline.extract_many, contents, ALL_FEATURES, detector)
+        except HTTPException as e:
+            results = [{"error": e.detail}] * len(batch)
+        except Exception as e:
+            results = [{"error": f"Error: {str(e)}"}] * len(batch)
+        return [batch_result_line(index, name, dict(result))
+                for (index, name, _), result in zip(batch, results)]
+
+    async def lines():
+        batch = []
+        index = -1
+        async for name, content in iter_batch_uploads(files):
+            index += 1
+            if isinstance(content, Exception):
+                yield batch_result_line(index, name, {"error": str(content)})
+                continue
+            batch.append((index, name, content))
+            if len(batch) == batch_size:
+                for line in await run_batch(batch):
+                    yield line
+                batch = []
+        if batch:
+            for line in await run_batch(batch):
+                yield line
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
 def build_palette_prompt(features):
     return (
         f"Suggest a 4-color palette (in hex codes) for a person with:\n"
@@ -300,104 +470,85 @@ def build_palette_prompt(features):
         f"Output format: HEX codes only, in array."
     )
 
-def get_palette_from_llm(prompt, api_key):
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "model": "mistralai/mistral-small-3.2-24b-instruct:free",  #mistral model AI
-        "messages": [{"role": "user", "content": prompt}]
-    }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()
+async def get_palette_from_llm(prompt, api_key):
+    # Pooled async OpenRouter client with timeouts, retries and a response cache
+    return await llm.chat(prompt, api_key)
+
+def build_image_palette_prompt(features, season=None, prompt=None):
+    return (
+        "You are a professional color consultant. "
+        "Given the following personal color analysis data, generate a personalized color palette and recommendations.\n\n"
+        f"Detected season: {season}\n"
+        f"Skin color (HEX): {features.get('skin', {}).get('dominant_color_hex', 'N/A')}\n"
+        f"Hair color (HEX): {features.get('hair', {}).get('dominant_color_hex', 'N/A')}\n"
+        f"Lip color (HEX): {features.get('lips', {}).get('dominant_color_hex', 'N/A')}\n"
+        f"Eye color (HEX): {features.get('eyes', {}).get('dominant_color_hex', 'N/A')}\n"
+        f"User undertone (if provided): {prompt if prompt else 'N/A'}\n\n"
+        "Based on these determine the user's personal color season that and give a diverse range of palette colors that suits them and"
+        "After that you have to give primary palette colors , warm tones , cool tones , neutral or black tones , clothing suggestions , makeup tips the format is specifies below"
+        "Very Important:  Include shades from light to dark for each major color family suitable for that season \n"
+        "(e.g., off-white to ivory, blush pink to rose, peach to burnt orange, mint to forest green, sky blue to navy, etc.)\n"
+        "Analyze the features, determine the best season, and return your analysis in the following JSON format:\n"
+        "Include primary color in primary and secondary colors in primary and seocndary  palettes, warm colrs in warm tones, cool colrs in cool tones, neutral or black colrs in neutral or black tones . very important use variety of shades for a diverse palette\n"
+        "{\n"
+        '  "season": "...",\n'
+        '  "why": "...(Do not use Hex codes and asterics, Give very short and precise answer)",\n'
+        '  "palettes": {\n'
+        '    "Primary and Secondary Colors": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",],\n'
+        '    "Warm Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",],\n'
+        '    "Cool Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",\n'
+        '    "Neutral or Black Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",\n'
+        "  },\n"
+        '  "More Colors": ["- #HEX (Color Name)", ...],\n'
+        '  "makeup": [\n'
+        '    { "part": "Lip", "hex": "...", "name": "..." },\n'
+        '    { "part": "Eyes", "hex": "...", "name": "..." },\n'
+        '    { "part": "Cheeks", "hex": "...", "name": "..." }\n'
+        "  ]\n"
+        "}\n"
+        "Do NOT include markdown, code blocks, or any text outside the JSON.And Do not use terms like user looks good , use you when explaining hwy this season, use different shades od colors everywhere and not the shades that just match the user"
+    )
+
+
+async def image_palette_inputs(content, season=None, quality="full"):
+    """Valid features of an uploaded image and its season (detected unless given)"""
+    result = await extract_features(content, quality=quality)
+    if not season and result["season"] is not None:
+        season = SEASON_NAMES.get(normalize_season(result["season"]))
+
+    features = {}
+    for name in ("skin", "hair", "lips", "eyes"):
+        value = result[name]
+        if value and isinstance(value, dict) and "dominant_color_hex" in value:
+            features[name] = value
+    return features, season
+
+NO_FEATURES_ERROR = "Could not extract any valid features (skin, hair, lips, eyes) from the image."
+
+def event_stream(events):
+    # Tell proxies not to buffer, so each event reaches the client right away
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/palette_llm")
 async def palette_llm(
     file: UploadFile = File(...),
     openrouter_api_key: str = Query(...),
     prompt: str = Form(None),
-    season: str = Form(None)  
+    season: str = Form(None),
+    quality: str = Query("full")
 ):
     try:
         if not openrouter_api_key:
             raise HTTPException(status_code=400, detail="API key required as query parameter.")
 
-        if file and file.filename:
-            print(f"Received file: {file.filename}")
-            with open("saved.jpg", "wb") as fi:
-                content = await file.read()
-                fi.write(content)
-        else:
-            raise HTTPException(status_code=400, detail="No image file provided. Please upload an image file.")
-
-        # Extract features
-        skin = f.analyze_skin_color("saved.jpg")
-        hair = f.analyze_hair_color("saved.jpg")
-        lips = f.analyze_lip_color("saved.jpg")
-        eyes = f.get_eye_color("saved.jpg")
-        os.remove("saved.jpg")
-
-        features = {}
-        if skin and isinstance(skin, dict) and "dominant_color_hex" in skin:
-            features["skin"] = skin
-        if hair and isinstance(hair, dict) and "dominant_color_hex" in hair:
-            features["hair"] = hair
-        if lips and isinstance(lips, dict) and "dominant_color_hex" in lips:
-            features["lips"] = lips
-        if eyes and isinstance(eyes, dict) and "dominant_color_hex" in eyes:
-            features["eyes"] = eyes
-
-        season_text = ""
-        if season:
-            season_text = f"\nThe best-matched season for this person (from our model) is: {season}. Consider this as a strong prior when generating the palette and analysis.\n"
-
-        undertone_text = ""
-        if prompt:
-            undertone_text = f"\nUser undertone information: {prompt}\n"
-
+        content = await read_upload(file)
+        features, season = await image_palette_inputs(content, season, quality)
         if not features:
-            return JSONResponse(
-                status_code=400,
-                content={"error": "Could not extract any valid features (skin, hair, lips, eyes) from the image."}
-            )
-
-        prompt_text = (
-            "You are a professional color consultant. "
-            "Given the following personal color analysis data, generate a personalized color palette and recommendations.\n\n"
-            f"Detected season: {season}\n"
-            f"Skin color (HEX): {features.get('skin', {}).get('dominant_color_hex', 'N/A')}\n"
-            f"Hair color (HEX): {features.get('hair', {}).get('dominant_color_hex', 'N/A')}\n"
-            f"Lip color (HEX): {features.get('lips', {}).get('dominant_color_hex', 'N/A')}\n"
-            f"Eye color (HEX): {features.get('eyes', {}).get('dominant_color_hex', 'N/A')}\n"
-            f"User undertone (if provided): {prompt if prompt else 'N/A'}\n\n"
-            "Based on these determine the user's personal color season that and give a diverse range of palette colors that suits them and"
-            "After that you have to give primary palette colors , warm tones , cool tones , neutral or black tones , clothing suggestions , makeup tips the format is specifies below"
-            "Very Important:  Include shades from light to dark for each major color family suitable for that season \n"
-            "(e.g., off-white to ivory, blush pink to rose, peach to burnt orange, mint to forest green, sky blue to navy, etc.)\n"
-            "Analyze the features, determine the best season, and return your analysis in the following JSON format:\n"
-            "Include primary color in primary and secondary colors in primary and seocndary  palettes, warm colrs in warm tones, cool colrs in cool tones, neutral or black colrs in neutral or black tones . very important use variety of shades for a diverse palette\n"
-            "{\n"
-            '  "season": "...",\n'
-            '  "why": "...(Do not use Hex codes and asterics, Give very short and precise answer)",\n'
-            '  "palettes": {\n'
-            '    "Primary and Secondary Colors": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",],\n'
-            '    "Warm Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",],\n'
-            '    "Cool Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",\n'
-            '    "Neutral or Black Tones": ["- #HEX (Color Name)",  "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)", "- #HEX (Color Name)",\n'
-            "  },\n"
-            '  "More Colors": ["- #HEX (Color Name)", ...],\n'
-            '  "makeup": [\n'
-            '    { "part": "Lip", "hex": "...", "name": "..." },\n'
-            '    { "part": "Eyes", "hex": "...", "name": "..." },\n'
-            '    { "part": "Cheeks", "hex": "...", "name": "..." }\n'
-            "  ]\n"
-            "}\n"
-            "Do NOT include markdown, code blocks, or any text outside the JSON.And Do not use terms like user looks good , use you when explaining hwy this season, use different shades od colors everywhere and not the shades that just match the user"
-        )
-
-        llm_response = get_palette_from_llm(prompt_text, openrouter_api_key)
+            return JSONResponse(status_code=400, content={"error": NO_FEATURES_ERROR})
+
+        prompt_text = build_image_palette_prompt(features, season, prompt)
+        llm_response = await get_palette_from_llm(prompt_text, openrouter_api_key)
         try:
             content = llm_response['choices'][0]['message']['content']
         except Exception as e:
@@ -410,48 +561,42 @@ async def palette_llm(
             "prompt": prompt_text
         })
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-def build_quiz_palette_prompt(quiz_answers):
-    return f"""
-You are a color theory expert analyzing personal color palettes.
-
-User's self-reported features:
-- Skin undertone: {quiz_answers.get('undertone')}
-- Natural hair color: {quiz_answers.get('hairColor')}
-- Natural eye color: {quiz_answers.get('eyeColor')}
-- Skin reaction to sun: {quiz_answers.get('sunReaction')}
-- Skin depth/tone: {quiz_answers.get('skinDepth')}
-- Vein color: {quiz_answers.get('veinColor')}
-
-Based on these features, analyze the user's likely personal color season (Spring, Summer, Autumn, Winter) using the same logic as if you had hex codes. Match their traits to the seasonal color theory below.
-User variety of shades for a diverse palette
-...
-
-Return ONLY a valid JSON object in this format:
-{{
-  "season": "...",
-  "why": "...",
-  "palettes": {{
-    "Primary and Secondary Colors": ["- #HEX (Color Name)", ...],
-    "Warm Tones": ["- #HEX (Color Name)", ...],
-    "Cool Tones": ["- #HEX (Color Name)", ...],
-    "Neutral or Black Tones": ["- #HEX (Color Name)", ...]
-  }},
-  "clothing": ["- #HEX (Color Name)", ...],
-  "makeup": [
-    {{ "part": "Lip", "hex": "...", "name": "..." }},
-    {{ "part": "Eyes", "hex": "...", "name": "..." }},
-    {{ "part": "Cheeks", "hex": "...", "name": "..." }}
-  ]
-}}
-Do NOT include markdown, code blocks, or any text outside the JSON. Do not use hex codes and asterics in the why section. Do not use words like user, use you in statements
-"""
-
+@app.post("/palette_llm/stream")
+async def palette_llm_stream(
+    file: UploadFile = File(...),
+    openrouter_api_key: str = Query(...),
+    prompt: str = Form(None),
+    season: str = Form(None),
+    quality: str = Query("full")
+):
+    # Same as /palette_llm as server-sent events: "features" first, then the
+    # LLM output as "token" events, a "section" event per completed palette
+    # section and a final "done" (or "error")
+    try:
+        if not openrouter_api_key:
+            raise HTTPException(status_code=400, detail="API key required as query parameter.")
 
+        content = await read_upload(file)
+        features, season = await image_palette_inputs(content, season, quality)
+        if not features:
+            return JSONResponse(status_code=400, content={"error": NO_FEATURES_ERROR})
+        prompt_text = build_image_palette_prompt(features, season, prompt)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+    async def events():
+        yield sse_event("features", {"features": features, "season": season})
+        async for event in palette_events(prompt_text, llm.stream(prompt_text, openrouter_api_key)):
+            yield event
 
+    return event_stream(events())
 
 @app.post("/quiz_palette_llm")
 async def quiz_palette_llm(
@@ -462,14 +607,11 @@ async def quiz_palette_llm(
         if not openrouter_api_key:
             raise HTTPException(status_code=400, detail="API key required as query parameter.")
 
-        
-        prompt_text = build_quiz_palette_prompt(quiz_answers)
-
-        llm_response = get_palette_from_llm(prompt_text, openrouter_api_key)
-        try:
-            content = llm_response['choices'][0]['message']['content']
-        except Exception as e:
-            content = str(llm_response)
+        # Answers come from a small finite set, so most prompts repeat and are
+        # answered from the quiz memo instead of a full LLM round trip
+        answers = normalize_quiz_answers(quiz_answers)
+        prompt_text = build_quiz_palette_prompt(answers)
+        content = await quiz_memo.get_or_fetch(answers, prompt_text, openrouter_api_key)
 
         return JSONResponse(content={
             "message": "complete",
@@ -478,28 +620,56 @@ async def quiz_palette_llm(
             "prompt": prompt_text
         })
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+@app.post("/quiz_palette_llm/stream")
+async def quiz_palette_llm_stream(
+    quiz_answers: dict = Body(...),
+    openrouter_api_key: str = Query(...)
+):
+    # Streaming /quiz_palette_llm; see /palette_llm/stream for the events
+    if not openrouter_api_key:
+        raise HTTPException(status_code=400, detail="API key required as query parameter.")
+
+    answers = normalize_quiz_answers(quiz_answers)
+    prompt_text = build_quiz_palette_prompt(answers)
+    memoized = quiz_memo.get(answers)
+
+    async def memoized_chunks():
+        yield memoized
+
+    async def events():
+        yield sse_event("answers", {"quiz_answers": answers})
+        if memoized is not None:
+            chunks = memoized_chunks()
+        else:
+            # Memoized only if the completion finished normally, not when it
+            # was cut off, empty or failed
+            chunks = llm.stream(prompt_text, openrouter_api_key,
+                                on_complete=lambda content: quiz_memo.put(answers, content))
+        async for event in palette_events(prompt_text, chunks):
+            yield event
+
+    return event_stream(events())
+
 @app.post("/api/style-recommendation")
 async def style_recommendation(request: Request, openrouter_api_key: str = Query(...)):
     data = await request.json()
     
-    suggestion = f.get_style_recommendation_from_llm(data, openrouter_api_key)
+    suggestion = await f.get_style_recommendation_from_llm(data, openrouter_api_key)
     return JSONResponse({"suggestion": suggestion})
 
 
 
 @app.get("/api/serpapi-proxy")
-def serpapi_proxy(q: str):
-    url = f"https://serpapi.com/search.json?q={q}&tbm=isch&api_key={SERPAPI_KEY}"
-    print(f"[SerpAPI Proxy] Requesting: {url}")
+async def serpapi_proxy(q: str):
     try:
-        resp = requests.get(url)
-        print(f"[SerpAPI Proxy] Response status: {resp.status_code}")
-        if resp.status_code != 200:
-            print(f"[SerpAPI Proxy] Error response: {resp.text}")
-        return JSONResponse(resp.json())
+        # Cached on the normalized query; identical concurrent queries share one upstream call
+        _, data = await serpapi.search_images(q)
+        return JSONResponse(data)
     except Exception as e:
         print(f"[SerpAPI Proxy] Exception: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
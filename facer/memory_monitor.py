@@ -1,6 +1,10 @@
-import psutil
-import os
+import asyncio
 import gc
+import os
+import threading
+import time
+
+import psutil
 
 def get_memory_usage():
     """Get current memory usage in MB"""
@@ -26,4 +30,227 @@ def check_memory_limit(limit_mb=500):
     if memory_mb > limit_mb:
         print(f"⚠️  Memory usage ({memory_mb:.2f} MB) exceeds limit ({limit_mb} MB)")
         return False
-    return True 
\ No newline at end of file
+    return True 
+
+def detect_memory_limit():
+    """Memory available to this process in MB: the cgroup limit if there is one, else physical RAM"""
+    limit = psutil.virtual_memory().total
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limit = min(limit, int(value))
+        break
+    return limit / 1024 / 1024
+
+
+# Peak memory (MB above the idle RSS) of one request to each endpoint, before
+# any measurement; endpoints that aren't listed are admitted without a check
+DEFAULT_ESTIMATES_MB = {
+    "/image": 150,
+    "/analyze_features": 150,
+    "/skin": 120,
+    "/hair": 120,
+    "/lip": 80,
+    "/eye": 60,
+    "/palette_llm": 150,
+    "/palette_llm/stream": 150,
+    "/batch/analyze": 400,
+}
+
+
+class MemoryBusy(RuntimeError):
+    """Raised when a request can't be admitted without risking an OOM kill"""
+
+    def __init__(self, retry_after):
+        super().__init__("Not enough memory to take the request")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ("endpoint", "estimate", "rss_start", "solo")
+
+    def __init__(self, endpoint, estimate, rss_start, solo):
+        self.endpoint = endpoint
+        self.estimate = estimate
+        self.rss_start = rss_start
+        self.solo = solo
+
+
+class AdmissionController:
+    """Admits requests only while their estimated peak memory fits under the limit.
+
+    A background thread samples the RSS every `sample_ms`. A request to an
+    endpoint with an estimate is admitted when the RSS plus what the requests
+    already in flight are still expected to add plus its own estimate stays
+    below `limit_mb` minus `reserve_mb`. Otherwise it waits (up to
+    `queue_timeout` seconds, at most `max_waiting` requests) for memory to be
+    released, and is rejected with `MemoryBusy` when that doesn't happen. A
+    request is always admitted when nothing is in flight, so the worker keeps
+    making progress (and measuring) whatever the estimates say. Estimates
+    start from DEFAULT_ESTIMATES_MB (MEMORY_ESTIMATES="/image=200,/lip=80"
+    overrides) and are raised to the largest peak measured for a request
+    that ran alone (after the first one to each endpoint, which also pays for
+    the model loads). They are never lowered by measurements: a warm worker
+    mostly reuses memory it already freed, and a short request can finish
+    between two samples, so both measure close to nothing.
+    """
+
+    def __init__(self, limit_mb=None, reserve_mb=None, sample_ms=None, queue_timeout=None,
+                 max_waiting=None, estimates=None, retry_after=None):
+        self.limit_mb = limit_mb or float(os.getenv("MEMORY_LIMIT_MB", "0")) or detect_memory_limit()
+        self.reserve_mb = reserve_mb if reserve_mb is not None else float(os.getenv("MEMORY_RESERVE_MB", "50"))
+        self.sample_interval = (sample_ms or float(os.getenv("MEMORY_SAMPLE_MS", "100"))) / 1000
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(os.getenv("MEMORY_QUEUE_TIMEOUT", "10"))
+        self.max_waiting = max_waiting if max_waiting is not None else int(os.getenv("MEMORY_QUEUE_SIZE", "16"))
+        self.retry_after = retry_after or int(os.getenv("MEMORY_RETRY_AFTER", "5"))
+
+        self.estimates = dict(DEFAULT_ESTIMATES_MB)
+        for item in os.getenv("MEMORY_ESTIMATES", "").split(","):
+            if "=" in item:
+                path, mb = item.split("=", 1)
+                self.estimates[path.strip()] = float(mb)
+        self.estimates.update(estimates or {})
+        self.measured = {}
+
+        self.rss = get_memory_usage()
+        self.peak = self.rss
+        self._tickets = set()
+        self._warm = set()
+        self._waiting = 0
+        self._thread = None
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+            self._thread.start()
+
+    def _sample(self):
+        while True:
+            self.rss = get_memory_usage()
+            self.peak = max(self.peak, self.rss)
+            time.sleep(self.sample_interval)
+
+    def estimate(self, endpoint):
+        return max(self.estimates.get(endpoint, 0), self.measured.get(endpoint, 0))
+
+    @property
+    def reserved_mb(self):
+        """Part of the estimates of the requests in flight that isn't in the RSS yet.
+
+        What the RSS grew by since the oldest of them started is counted as
+        their memory, so it isn't subtracted twice.
+        """
+        if not self._tickets:
+            return 0.0
+        grown = self.rss - min(ticket.rss_start for ticket in self._tickets)
+        return max(0.0, sum(ticket.estimate for ticket in self._tickets) - max(0.0, grown))
+
+    @property
+    def headroom_mb(self):
+        """Memory left for new requests: limit - reserve - RSS - reserved_mb"""
+        return self.limit_mb - self.reserve_mb - self.rss - self.reserved_mb
+
+    async def acquire(self, endpoint):
+        if endpoint not in self.estimates and endpoint not in self.measured:
+            return None
+        estimate = self.estimate(endpoint)
+
+        if estimate > self.headroom_mb and self._tickets:
+            if self._waiting >= self.max_waiting:
+                self.rejected += 1
+                raise MemoryBusy(self.retry_after)
+            self._waiting += 1
+            self.queued += 1
+            try:
+                await self._wait_for(estimate)
+            finally:
+                self._waiting -= 1
+
+        for ticket in self._tickets:
+            ticket.solo = False
+        # Fresh reading: the sampled one can be a whole interval old
+        self.rss = self.peak = get_memory_usage()
+        ticket = _Ticket(endpoint, estimate, self.rss, solo=not self._tickets)
+        self._tickets.add(ticket)
+        self.admitted += 1
+        return ticket
+
+    async def _wait_for(self, estimate):
+        deadline = time.monotonic() + self.queue_timeout
+        # Once nothing is in flight the request runs anyway: waiting longer
+        # can't free memory, and rejecting it would stall the worker
+        while estimate > self.headroom_mb and self._tickets:
+            if time.monotonic() >= deadline:
+                self.rejected += 1
+                raise MemoryBusy(self.retry_after)
+            await asyncio.sleep(self.sample_interval)
+
+    def release(self, ticket):
+        if ticket is None:
+            return
+        self._tickets.discard(ticket)
+        if ticket.solo:
+            if ticket.endpoint not in self._warm:
+                # The first request also pays for lazy imports and model loads
+                self._warm.add(ticket.endpoint)
+                return
+            self.peak = max(self.peak, get_memory_usage())
+            used = round(self.peak - ticket.rss_start, 1)
+            if used > 0:
+                self.measured[ticket.endpoint] = max(self.measured.get(ticket.endpoint, 0), used)
+
+    def stats(self):
+        return {
+            "limit_mb": round(self.limit_mb, 1),
+            "reserve_mb": self.reserve_mb,
+            "rss_mb": round(self.rss, 1),
+            "reserved_mb": round(self.reserved_mb, 1),
+            "headroom_mb": round(self.headroom_mb, 1),
+            "in_flight": len(self._tickets),
+            "waiting": self._waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "estimates_mb": {endpoint: self.estimate(endpoint) for endpoint in self.estimates},
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware putting every HTTP request through an `AdmissionController`.
+
+    Rejected requests get a 503 with Retry-After before any of their work
+    (including reading the upload) is done.
+    """
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        try:
+            ticket = await self.controller.acquire(scope["path"])
+        except MemoryBusy as e:
+            body = b'{"detail":"Server is low on memory, please retry."}'
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(body)).encode()),
+                                    (b"retry-after", str(e.retry_after).encode())]})
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(ticket)
+
+
+admission = AdmissionController()
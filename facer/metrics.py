@@ -0,0 +1,259 @@
+"""In-process metrics in the Prometheus text format.
+
+Request handlers run with `endpoint` set (by `MetricsMiddleware`), and
+`stage("retinaface")` blocks record their duration into the stage histogram
+under that endpoint. The inference executor copies the request's context into
+its workers, so stages timed there are attributed to the right endpoint too.
+Collectors registered with `register_collector` add point-in-time gauges
+(queue depth, cache hit rates, model load times) when `/metrics` is rendered.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+endpoint = contextvars.ContextVar("endpoint", default="none")
+# Set by `collect_stages`: stage timings go to this list instead of the histograms
+_collector = contextvars.ContextVar("stage_collector", default=None)
+# Stage timings of the current request, for its Server-Timing header
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def _samples(self, key, state):
+        counts, count, total = state
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {count}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+        return lines
+
+
+REGISTRY = []
+_collectors = []
+
+STAGE_SECONDS = Histogram("facer_stage_duration_seconds",
+                          "Time spent in each pipeline stage", ("stage", "endpoint"))
+REQUEST_SECONDS = Histogram("facer_request_duration_seconds",
+                            "Time to the end of the response", ("endpoint", "status"))
+REQUESTS_IN_FLIGHT = Gauge("facer_requests_in_flight", "Requests being handled", ("endpoint",))
+CACHE_LOOKUPS = Counter("facer_cache_lookups_total", "Cache lookups by result", ("cache", "result", "endpoint"))
+
+
+def record_stage(name, seconds):
+    collector = _collector.get()
+    if collector is not None:
+        collector.append((name, seconds))
+        return
+    STAGE_SECONDS.observe(seconds, stage=name, endpoint=endpoint.get())
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def record_stages(timings):
+    """Record stage timings collected elsewhere (e.g. a shared batch) for this request"""
+    for name, seconds in timings:
+        record_stage(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time the block as pipeline stage `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_stages():
+    """Collect the stages timed in the block into a list instead of recording them"""
+    timings = []
+    token = _collector.set(timings)
+    try:
+        yield timings
+    finally:
+        _collector.reset(token)
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss", endpoint=endpoint.get())
+
+
+def register_collector(collect):
+    """Add the gauges returned by `collect()` to the rendered metrics.
+
+    `collect` returns a list of (name, documentation, samples), samples being
+    a list of (labels dict, value).
+    """
+    _collectors.append(collect)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} "
+                             f"{_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def request_timings():
+    """Stage timings recorded so far for the current request (None outside a request)"""
+    return _request_timings.get()
+
+
+def server_timing(timings, total):
+    """Server-Timing header value: time per stage (summed over repeats) and the total"""
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+class MetricsMiddleware:
+    """ASGI middleware that labels each request with its endpoint and times it.
+
+    Paths that aren't routes of the app are labelled "other", so scanners
+    can't blow up the number of series. Every response gets a Server-Timing
+    header with the stages that ran before it started.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths = None
+
+    def _endpoint(self, scope):
+        if self._paths is None:
+            self._paths = {route.path for route in scope["app"].routes if hasattr(route, "path")}
+        path = scope["path"]
+        return path if path in self._paths else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        name = self._endpoint(scope)
+        token = endpoint.set(name)
+        timings = []
+        timings_token = _request_timings.set(timings)
+        status = 500
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc(endpoint=name)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = server_timing(timings, time.perf_counter() - start)
+                message = {**message, "headers": list(message.get("headers", [])) +
+                           [(b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(endpoint=name)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=name, status=status)
+            _request_timings.reset(timings_token)
+            endpoint.reset(token)
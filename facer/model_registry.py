@@ -0,0 +1,195 @@
+import gc
+import os
+import threading
+import time
+
+import metrics
+
+# Memory monitoring is optional, same as in main.py
+try:
+    from memory_monitor import get_memory_usage
+except ImportError:
+    def get_memory_usage(): return 0.0
+
+
+DEFAULT_DETECTOR = 'retinaface/mobilenet'
+DEFAULT_PARSER = 'farl/lapa/448'
+
+QUALITIES = ("full", "fast")
+# Long side the detector input is downscaled to with quality=fast
+FAST_DETECT_SIZE = int(os.getenv("FAST_DETECT_SIZE", "320"))
+
+
+# Inference backend of each model: torch, onnx to run its net in ONNX
+# Runtime (see onnx_backend), or int8 for the quantized detector and skin
+# model (see quantize)
+BACKENDS = {
+    "detector": os.getenv("DETECTOR_BACKEND", "torch"),
+    "parser": os.getenv("PARSER_BACKEND", "torch"),
+    "skin": os.getenv("SKIN_BACKEND", "torch"),
+}
+
+
+def detector_name(quality="full"):
+    """Detector conf name for a quality level of the API"""
+    if quality == "fast":
+        return f"{DEFAULT_DETECTOR}@{FAST_DETECT_SIZE}"
+    return DEFAULT_DETECTOR
+
+
+def _module_size_mb(model):
+    """Size of the parameters and buffers of a torch module in MB (0 if unknown)"""
+    module = getattr(model, '_model', model)
+    if module is None or not hasattr(module, 'parameters'):
+        return 0.0
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total / 1024 / 1024
+
+
+class ModelRegistry:
+    """Builds every model once per process and hands out the shared instance.
+
+    Models are put in eval mode with gradients disabled, so callers only need
+    to wrap their calls in `torch.inference_mode()`. Loads are serialized by a
+    single lock so the RSS delta recorded for each model is attributable to it.
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._models = {}
+        self._stats = {}
+        self._lock = threading.RLock()
+
+    def register(self, name, builder):
+        """Register a zero-argument callable that builds the model `name`"""
+        with self._lock:
+            self._builders[name] = builder
+
+    def register_default(self, name, builder):
+        """Register `builder` for `name` unless one was registered already
+        (e.g. a stand-in model for benchmarks)"""
+        with self._lock:
+            self._builders.setdefault(name, builder)
+
+    def get(self, name):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                return model
+            if name not in self._builders:
+                raise RuntimeError(f'Unknown model: {name}')
+
+            print(f"Loading {name} (model registry)...")
+            gc.collect()
+            rss_before = get_memory_usage()
+            start = time.perf_counter()
+            model = self._builders[name]()
+            _freeze(model)
+            load_time = time.perf_counter() - start
+            gc.collect()
+            rss_after = get_memory_usage()
+
+            self._stats[name] = {
+                "load_time_s": round(load_time, 3),
+                "rss_delta_mb": round(rss_after - rss_before, 2),
+                "weights_mb": round(_module_size_mb(model), 2),
+            }
+            self._models[name] = model
+            print(f"Loaded {name} in {load_time:.2f}s")
+            # A request that had to wait for a cold model shows it in its timings
+            metrics.record_stage("model_load", load_time)
+            return model
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def stats(self):
+        """Load time and memory of every model loaded so far"""
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def clear(self):
+        """Drop every loaded model (mostly useful for tests and benchmarks)"""
+        with self._lock:
+            self._models.clear()
+            self._stats.clear()
+        gc.collect()
+
+
+def _freeze(model):
+    """Put a model in inference mode: eval() and no gradients"""
+    module = getattr(model, '_model', model)
+    if hasattr(module, 'eval'):
+        module.eval()
+    # Parameter by parameter, which also works for TorchScript modules
+    if hasattr(module, 'parameters'):
+        for param in module.parameters():
+            param.requires_grad_(False)
+
+
+def get_device():
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+registry = ModelRegistry()
+
+
+def _key(kind, name, backend):
+    """Registry name of a model; the torch one is plain, e.g. detector:retinaface/mobilenet"""
+    return f'{kind}:{name}' if backend == "torch" else f'{kind}:{name}:{backend}'
+
+
+def get_face_detector(name=DEFAULT_DETECTOR, backend=None):
+    backend = backend or BACKENDS["detector"]
+    key = _key('detector', name, backend)
+    if not registry.is_loaded(key):
+        def build():
+            if backend == "onnx":
+                import onnx_backend
+                return onnx_backend.OrtRetinaFaceDetector(name)
+            if backend == "int8":
+                import quantize
+                return quantize.Int8RetinaFaceDetector(name)
+            import facer
+            return facer.face_detector(name, device=get_device())
+        registry.register_default(key, build)
+    return registry.get(key)
+
+
+def get_face_parser(name=DEFAULT_PARSER, backend=None):
+    backend = backend or BACKENDS["parser"]
+    key = _key('parser', name, backend)
+    if not registry.is_loaded(key):
+        def build():
+            if backend == "onnx":
+                import onnx_backend
+                return onnx_backend.OrtFaRLFaceParser(name)
+            import facer
+            return facer.face_parser(name, device=get_device())
+        registry.register_default(key, build)
+    return registry.get(key)
+
+
+def get_skin_model(backend=None):
+    backend = backend or BACKENDS["skin"]
+    key = _key('skin', 'resnet18', backend)
+    if not registry.is_loaded(key):
+        def build():
+            if backend == "onnx":
+                import onnx_backend
+                return onnx_backend.skin_model()
+            if backend == "int8":
+                import quantize
+                return quantize.skin_model()
+            from skin_model import LazySkinModel
+            model = LazySkinModel()
+            model._load_model()
+            return model
+        registry.register_default(key, build)
+    return registry.get(key)
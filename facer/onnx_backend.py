@@ -0,0 +1,284 @@
+"""ONNX Runtime backend for the detector, the face parser and the skin classifier.
+
+    python -m onnx_backend export                  # writes cp/onnx/*.onnx
+    python -m onnx_backend check --sizes 600x450   # ONNX Runtime vs torch outputs
+
+Each model is switched to ONNX Runtime on its own, with DETECTOR_BACKEND,
+PARSER_BACKEND and SKIN_BACKEND set to `onnx` (the default is `torch`). Only the
+nets run in ONNX Runtime: resizing, PriorBox, NMS, FaRL's warps and the skin
+preprocessing stay the same torch code, so every backend gives the same kind
+of outputs to the pipeline.
+
+onnxruntime is optional (pip install onnxruntime); export only needs torch.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import model_registry
+from facer.face_detection import retinaface
+from facer.face_parsing.farl import FaRLFaceParser, pretrain_settings
+from skin_model import LazySkinModel
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+ONNX_DIR = os.getenv("ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cp", "onnx"))
+KINDS = ("detector", "parser", "skin")
+OPT_LEVELS = {
+    "disabled": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def model_path(kind, name=None):
+    """Path of the exported graph of a model, e.g. cp/onnx/retinaface_mobilenet.onnx"""
+    if kind == "detector":
+        name = (name or model_registry.DEFAULT_DETECTOR).partition("@")[0]
+    elif kind == "parser":
+        name = name or model_registry.DEFAULT_PARSER
+    else:
+        name = "skin/resnet18"
+    return os.path.join(ONNX_DIR, name.replace("/", "_") + ".onnx")
+
+
+def session_options():
+    """Graph optimizations and threads of every session, from the environment"""
+    options = ort.SessionOptions()
+    level = os.getenv("ORT_OPT_LEVEL", "all")
+    if level not in OPT_LEVELS:
+        raise ValueError(f"ORT_OPT_LEVEL must be one of: {', '.join(OPT_LEVELS)}")
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, OPT_LEVELS[level])
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # Same thread budget as torch unless set, so switching a model's backend
+    # doesn't change how many cores a request may use
+    options.intra_op_num_threads = int(os.getenv("ORT_INTRA_OP_THREADS", "0")) or torch.get_num_threads()
+    options.inter_op_num_threads = int(os.getenv("ORT_INTER_OP_THREADS", "1"))
+    # Idle pool threads would otherwise spin and take CPU from the torch models
+    # and the other requests
+    options.add_session_config_entry(
+        "session.intra_op.allow_spinning", os.getenv("ORT_ALLOW_SPINNING", "0"))
+    return options
+
+
+class OrtModule(nn.Module):
+    """An exported net run by ONNX Runtime, called like the torch module it replaces"""
+
+    def __init__(self, path):
+        super().__init__()
+        if ort is None:
+            raise RuntimeError("The onnx backend needs onnxruntime (pip install onnxruntime)")
+        if not os.path.exists(path):
+            raise RuntimeError(f"{path} not found, export it with: python -m onnx_backend export")
+        self.path = path
+        self.session = ort.InferenceSession(path, session_options(), providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward(self, x):
+        inputs = {self.input_name: np.ascontiguousarray(x.detach().float().cpu().numpy())}
+        outputs = [torch.from_numpy(output).to(x.device) for output in self.session.run(None, inputs)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class _OrtSegmenter(OrtModule):
+    """FaRL's net returns (logits, aux); only the logits are exported"""
+
+    def forward(self, x):
+        return super().forward(x), None
+
+
+class OrtRetinaFaceDetector(retinaface.RetinaFaceDetector):
+    def __init__(self, name=model_registry.DEFAULT_DETECTOR):
+        nn.Module.__init__(self)
+        size = name.partition("@")[2]
+        self.max_size = int(size) if size else None
+        self.net = OrtModule(model_path("detector", name))
+
+
+class OrtFaRLFaceParser(FaRLFaceParser):
+    def __init__(self, name=model_registry.DEFAULT_PARSER):
+        nn.Module.__init__(self)
+        self.conf_name = name.split("/", 1)[1]
+        self.net = _OrtSegmenter(model_path("parser", name))
+
+
+class OrtSkinModel(LazySkinModel):
+    _instance = None
+
+    def _load_model(self):
+        if not self._loaded:
+            import torchvision.transforms as transforms
+
+            self._model = OrtModule(model_path("skin"))
+            self._transform = transforms.Compose([
+                transforms.Resize((160, 160)),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5,), (0.5,))
+            ])
+            self._loaded = True
+
+
+def skin_model():
+    model = OrtSkinModel()
+    model._load_model()
+    return model
+
+
+class _Logits(nn.Module):
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x)[0]
+
+
+def torch_net(kind):
+    """The torch net of a model, loaded by the registry with the torch backend
+    whatever backend the model is configured with"""
+    if kind == "detector":
+        return model_registry.get_face_detector(backend="torch").net
+    if kind == "parser":
+        # In eval mode like the net: export restores the wrapper's mode on
+        # everything inside it, which would turn the parser's dropout on
+        return _Logits(model_registry.get_face_parser(backend="torch").net).eval()
+    return model_registry.get_skin_model(backend="torch")._model
+
+
+def sample_input(kind, size=None, seed=0):
+    """An input of the net like the ones the pipeline gives it, `size` (h, w)
+    being the image size for the detector"""
+    from benchmarks import synthetic
+
+    if kind == "detector":
+        h, w = size or (480, 640)
+        img, _ = synthetic.face_image(w, h, 1, seed)
+        x = torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0).float()
+        return x - torch.tensor([104., 117., 123.]).view(1, 3, 1, 1)
+    if kind == "parser":
+        setting = pretrain_settings[model_registry.DEFAULT_PARSER.split("/", 1)[1]]
+        h, w = setting["get_grid_fn"].keywords["warped_shape"]
+        img, _ = synthetic.face_image(w, h, 1, seed)
+        return torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0).float() / 255
+    img, _ = synthetic.face_image(160, 160, 1, seed)
+    return (torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0).float() / 255 - 0.5) / 0.5
+
+
+def export(kind, opset=13):
+    """Export the torch net of a model to `model_path(kind)`"""
+    net = torch_net(kind)
+    path = model_path(kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if kind == "detector":
+        outputs = ["loc", "conf", "landms"]
+        axes = {"images": {0: "batch", 2: "height", 3: "width"}}
+        axes.update({name: {0: "batch", 1: "priors"} for name in outputs})
+    else:
+        outputs = ["logits"]
+        axes = {"images": {0: "batch"}, "logits": {0: "batch"}}
+    start = time.perf_counter()
+    with torch.no_grad():
+        torch.onnx.export(net, sample_input(kind), path, input_names=["images"], output_names=outputs,
+                          dynamic_axes=axes, opset_version=opset, do_constant_folding=True)
+    print(f"Exported {kind} to {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+def _median_ms(fn, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def check(kind, sizes, batch, rtol, atol, rounds):
+    """Compare the outputs of the torch net and its ONNX Runtime session.
+
+    Returns a row per input shape: the largest absolute difference, whether it
+    is within `atol + rtol * |torch output|`, and the median time of both.
+    """
+    net = torch_net(kind)
+    session = (_OrtSegmenter if kind == "parser" else OrtModule)(model_path(kind))
+    rows = []
+    for size in (sizes if kind == "detector" else [None]):
+        x = torch.cat([sample_input(kind, size, seed) for seed in range(batch)])
+        with torch.inference_mode():
+            expected = net(x)
+            actual = session(x)
+            if kind == "parser":
+                actual = actual[0]
+            expected = expected if isinstance(expected, tuple) else (expected,)
+            actual = actual if isinstance(actual, tuple) else (actual,)
+            diff = max((a - e).abs().max().item() for a, e in zip(actual, expected))
+            ok = all(torch.allclose(a, e, rtol=rtol, atol=atol) for a, e in zip(actual, expected))
+            if kind == "skin":
+                ok = ok and torch.equal(actual[0].argmax(1), expected[0].argmax(1))
+            torch_ms = _median_ms(lambda: net(x), rounds)
+            ort_ms = _median_ms(lambda: session(x), rounds)
+        shape = "x".join(str(d) for d in x.shape)
+        rows.append({"model": kind, "input": shape, "max_abs_diff": diff, "ok": ok,
+                     "torch_ms": torch_ms, "ort_ms": ort_ms})
+    return rows
+
+
+def _parse_size(text):
+    w, h = text.lower().split("x")
+    return int(h), int(w)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stub-models", action="store_true",
+                        help="Use the stand-in models of benchmarks.stub_models (no weights needed)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export the torch nets to ONNX")
+    export_parser.add_argument("models", nargs="*", help=f"Any of {', '.join(KINDS)} (default: all)")
+    export_parser.add_argument("--opset", type=int, default=13)
+    check_parser = subparsers.add_parser("check", help="Compare ONNX Runtime outputs with torch")
+    check_parser.add_argument("models", nargs="*", help=f"Any of {', '.join(KINDS)} (default: all)")
+    check_parser.add_argument("--sizes", default="600x450,1200x900", help="Detector input sizes, WxH")
+    check_parser.add_argument("--batch", type=int, default=1)
+    check_parser.add_argument("--rtol", type=float, default=1e-3)
+    check_parser.add_argument("--atol", type=float, default=1e-4)
+    check_parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    unknown = set(args.models) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown models: {', '.join(sorted(unknown))}")
+    models = args.models or KINDS
+
+    if args.stub_models:
+        from benchmarks import stub_models
+        stub_models.install()
+
+    if args.command == "export":
+        for kind in models:
+            export(kind, args.opset)
+        return
+
+    sizes = [_parse_size(size) for size in args.sizes.split(",")]
+    rows = []
+    for kind in models:
+        rows.extend(check(kind, sizes, args.batch, args.rtol, args.atol, args.rounds))
+    print(f"{'model':<10}{'input':<18}{'max diff':>12}{'torch ms':>10}{'ort ms':>10}  ok")
+    for row in rows:
+        print(f"{row['model']:<10}{row['input']:<18}{row['max_abs_diff']:>12.2e}"
+              f"{row['torch_ms']:>10.1f}{row['ort_ms']:>10.1f}  {'yes' if row['ok'] else 'NO'}")
+    if not all(row["ok"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
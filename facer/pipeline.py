@@ -0,0 +1,161 @@
+import cv2
+
+import functions as f
+import model_registry
+import skin_model as m
+from batching import scheduler
+from result_cache import cache
+
+# Bump when a change to the pipeline changes its outputs
+PIPELINE_VERSION = 3
+
+ALL_FEATURES = ("skin", "hair", "lips", "eyes", "season")
+# Features that need the RetinaFace + FaRL segmentation
+SEGMENTATION_FEATURES = {"skin", "hair", "lips", "season"}
+
+SEASON_NAMES = {1: "Spring", 2: "Summer", 3: "Autumn", 4: "Winter"}
+
+
+def decode_image(content, max_size=600):
+    """Decode uploaded bytes into an RGB image (h x w x 3, uint8), downscaled
+    so that its long side is at most `max_size`"""
+    return f.compress_image(content, max_size=max_size)
+
+
+def normalize_season(index):
+    """Map the skin model class index to the 1..4 season numbering of the API"""
+    if index is None:
+        return None
+    if index == 3:
+        return 4
+    if index == 0:
+        return 3
+    return index
+
+
+class FeaturePipeline:
+    """Single-pass feature extraction.
+
+    The image is decoded once and RetinaFace + FaRL run once (micro-batched
+    with concurrent requests by the batch scheduler); skin, hair and lip
+    colours and the season are all computed from that one segmentation.
+    MediaPipe runs on the same decoded image for the eye colour.
+
+    `detector` is the conf name of the face detector (None for the default),
+    e.g. `model_registry.detector_name("fast")`.
+    """
+
+    def __init__(self, max_size=600):
+        self.max_size = max_size
+
+    def extract(self, content, features=ALL_FEATURES, detector=None):
+        """Run the pipeline on uploaded image bytes"""
+        return self.extract_image(decode_image(content, self.max_size), features, detector)
+
+    def extract_image(self, img, features=ALL_FEATURES, detector=None):
+        """Run the pipeline on a decoded RGB image.
+
+        Returns a dict with one entry per requested feature. Skin, hair and
+        lips follow the format of the `analyze_*_color` functions, eyes the one
+        of `get_eye_color` and season is the raw skin model class index (None
+        when no face was found).
+
+        Results are cached by image content: features already extracted from
+        the same image are served from the cache without running any model.
+        """
+        features = set(features)
+        key = self._key(img, detector)
+        cached = cache.get(key, features) or {}
+
+        missing = features - cached.keys()
+        if missing:
+            cached.update(self._compute(img, missing, detector))
+            cache.put(key, cached)
+        return {name: cached[name] for name in features}
+
+    def extract_many(self, contents, features=ALL_FEATURES, detector=None):
+        """Decode a list of uploaded images and run `extract_batch` on them.
+
+        Returns one entry per upload, `{"error": ...}` for the ones that can't
+        be decoded.
+        """
+        results = [None] * len(contents)
+        images = []
+        for i, content in enumerate(contents):
+            try:
+                images.append((i, decode_image(content, self.max_size)))
+            except ValueError as e:
+                results[i] = {"error": str(e)}
+        if images:
+            extracted = self.extract_batch([img for _, img in images], features, detector)
+            for (i, _), result in zip(images, extracted):
+                results[i] = result
+        return results
+
+    def extract_batch(self, images, features=ALL_FEATURES, detector=None):
+        """Run the pipeline on a list of decoded RGB images.
+
+        Like `extract_image`, but the images that miss the cache are segmented
+        together in one batched RetinaFace + FaRL call instead of going
+        through the batch scheduler one by one.
+        """
+        features = set(features)
+        keys = [self._key(img, detector) for img in images]
+        entries = [cache.get(key, features) or {} for key in keys]
+
+        todo = [i for i, entry in enumerate(entries) if features - entry.keys()]
+        segmentations = [None] * len(images)
+        if any((features - entries[i].keys()) & SEGMENTATION_FEATURES for i in todo):
+            for i, segmentation in zip(todo, f.segment_batch([images[i] for i in todo], detector)):
+                segmentations[i] = segmentation
+
+        for i in todo:
+            entries[i].update(self._features(images[i], features - entries[i].keys(), segmentations[i]))
+            cache.put(keys[i], entries[i])
+        return [{name: entry[name] for name in features} for entry in entries]
+
+    @staticmethod
+    def _key(img, detector):
+        # Results of another detector than the default are cached separately
+        if detector and detector != model_registry.DEFAULT_DETECTOR:
+            return cache.make_key(img, f"{PIPELINE_VERSION}:{detector}")
+        return cache.make_key(img, PIPELINE_VERSION)
+
+    def _compute(self, img, features, detector=None):
+        segmentation = None
+        if features & SEGMENTATION_FEATURES:
+            segmentation = scheduler.segment(img, detector)
+        return self._features(img, features, segmentation)
+
+    def _features(self, img, features, segmentation):
+        result = {}
+        if "skin" in features:
+            result["skin"] = self._region_color(img, segmentation, "skin", "face")
+        if "hair" in features:
+            result["hair"] = self._region_color(img, segmentation, "hair", "hair")
+        if "lips" in features:
+            if segmentation is None:
+                result["lips"] = {"error": "No face detected"}
+            else:
+                lip_pixels = img[f.region_mask(segmentation, 'ulip', 'llip')]
+                result["lips"] = f.lip_color_from_pixels(lip_pixels)
+        if "eyes" in features:
+            result["eyes"] = f.eye_color_from_image(cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+        if "season" in features:
+            result["season"] = None
+            if segmentation is not None:
+                result["season"] = m.get_season(f.skin_mask_image(img, segmentation))
+
+        return result
+
+    @staticmethod
+    def _region_color(img, segmentation, feature, label_name):
+        if segmentation is None:
+            return {"error": "No face detected"}
+        pixels = img[f.region_mask(segmentation, label_name)]
+        if len(pixels) == 0:
+            return {"error": f"No {feature} region detected"}
+        return f.dominant_color(pixels)
+
+
+pipeline = FeaturePipeline()
@@ -0,0 +1,168 @@
+"""Opt-in per-request profiling: `?profile=1` on any endpoint.
+
+Only clients whose address is in PROFILE_ALLOWLIST (comma separated, empty by
+default, i.e. off) can use it. The address is the one of the connection's
+peer; behind a load balancer, list the balancer in PROFILE_TRUSTED_PROXIES and
+the client is then taken from the last X-Forwarded-For entry. The request's
+inference jobs run under cProfile (segmentation runs in the job instead of the
+shared batch thread), and the response is replaced by a JSON summary: the
+original status and body, the stage timings and the hottest functions by
+cumulative time. Torch ops show up as the builtin methods that call them.
+
+The event loop isn't profiled: a profiler there would also record the other
+requests running on the loop meanwhile, and profiles of overlapping requests
+would replace each other's hook.
+"""
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import urllib.parse
+
+import metrics
+
+# cProfile.Profile objects of the current request, one per thread it ran in
+_profiles = contextvars.ContextVar("profiles", default=None)
+
+
+def profiling():
+    """Whether the current request is being profiled"""
+    return _profiles.get() is not None
+
+
+def run_profiled(fn, *args, **kwargs):
+    """Call `fn`, under its own profiler if the current request is profiled"""
+    profiles = _profiles.get()
+    if profiles is None:
+        return fn(*args, **kwargs)
+    profile = cProfile.Profile()
+    profiles.append(profile)
+    return profile.runcall(fn, *args, **kwargs)
+
+
+class _Stats:
+    """Profile stats of a job run in another process, in the form pstats loads"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profile_stats(profile, fn, *args, **kwargs):
+    """Call `fn`, under a profiler if `profile` is set. Returns its result and
+    the profiler's stats (picklable, None when not profiled), for jobs run in
+    a worker process where the request's profiles can't be reached"""
+    if not profile:
+        return fn(*args, **kwargs), None
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn, *args, **kwargs)
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+def add_stats(stats):
+    """Add stats from `profile_stats` to the current request's profile"""
+    profiles = _profiles.get()
+    if profiles is not None and stats:
+        profiles.append(_Stats(stats))
+
+
+def summarize(profiles, limit):
+    if not profiles:
+        return []
+    stats = pstats.Stats(profiles[0], stream=io.StringIO())
+    for profile in profiles[1:]:
+        stats.add(profile)
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": f"{os.path.basename(filename)}:{line}({function})",
+            "calls": calls,
+            "tottime_ms": round(tottime * 1000, 2),
+            "cumtime_ms": round(cumtime * 1000, 2),
+        })
+    rows.sort(key=lambda row: row["cumtime_ms"], reverse=True)
+    return rows[:limit]
+
+
+class ProfilingMiddleware:
+    """ASGI middleware serving `?profile=1` for allowlisted clients.
+
+    Sits inside `MetricsMiddleware`, so the stage timings are available.
+    """
+
+    def __init__(self, app, allowlist=None, limit=None, trusted_proxies=None):
+        self.app = app
+        allowlist = allowlist if allowlist is not None else os.getenv("PROFILE_ALLOWLIST", "")
+        self.allowlist = {address.strip() for address in allowlist.split(",") if address.strip()}
+        trusted_proxies = trusted_proxies if trusted_proxies is not None else os.getenv("PROFILE_TRUSTED_PROXIES", "")
+        self.trusted_proxies = {address.strip() for address in trusted_proxies.split(",") if address.strip()}
+        self.limit = limit or int(os.getenv("PROFILE_TOP", "30"))
+
+    def _client_address(self, scope):
+        client = scope.get("client")
+        if client is None:
+            return None
+        if client[0] not in self.trusted_proxies:
+            return client[0]
+        # The last entry is the one the trusted proxy added; earlier ones are
+        # whatever the client sent
+        forwarded = b",".join(value for name, value in scope.get("headers", []) if name == b"x-forwarded-for")
+        addresses = [address.strip() for address in forwarded.decode("latin-1").split(",") if address.strip()]
+        return addresses[-1] if addresses else None
+
+    def _requested(self, scope):
+        if scope["type"] != "http" or not self.allowlist:
+            return False
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if query.get("profile", ["0"])[-1] not in ("1", "true"):
+            return False
+        return self._client_address(scope) in self.allowlist
+
+    async def __call__(self, scope, receive, send):
+        if not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        response = {"status": 500, "headers": [], "body": []}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        profiles = []
+        token = _profiles.set(profiles)
+        timings = metrics.request_timings()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            _profiles.reset(token)
+        elapsed = time.perf_counter() - start
+
+        body = b"".join(response["body"])
+        content_type = dict(response["headers"]).get(b"content-type", b"").decode("latin-1")
+        try:
+            original = json.loads(body) if content_type.startswith("application/json") else body.decode()
+        except ValueError:
+            original = body.decode("utf-8", "replace")
+
+        summary = json.dumps({
+            "status_code": response["status"],
+            "response": original,
+            "total_ms": round(elapsed * 1000, 1),
+            "stages_ms": [[name, round(seconds * 1000, 1)] for name, seconds in timings or []],
+            "profile": summarize(profiles, self.limit),
+        }).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(summary)).encode())]})
+        await send({"type": "http.response.body", "body": summary})
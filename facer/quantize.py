@@ -0,0 +1,332 @@
+"""INT8 versions of the RetinaFace net and the skin ResNet18.
+
+    python -m quantize calibrate faces/                # writes cp/int8/*.pt
+    python -m quantize report holdout/ -o int8.json    # INT8 vs FP32 on other faces
+
+Post-training static quantization (FX graph mode, fbgemm): observers are
+calibrated on the images of a folder of sample faces, decoded the way the
+pipeline decodes uploads, and the converted models are saved as TorchScript.
+Start the backend with DETECTOR_BACKEND=int8 and/or SKIN_BACKEND=int8 to use
+them. Quantized kernels run on CPU only.
+"""
+import argparse
+import copy
+import json
+import os
+import statistics
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import model_registry
+from facer.face_detection import retinaface
+from skin_model import LazySkinModel
+
+INT8_DIR = os.getenv("INT8_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cp", "int8"))
+KINDS = ("detector", "skin")
+ENGINE = "fbgemm"
+DETECTOR_MEAN = (104, 117, 123)
+
+
+def model_path(kind, name=None):
+    """Path of the quantized TorchScript of a model, e.g. cp/int8/retinaface_mobilenet.pt"""
+    if kind == "detector":
+        name = (name or model_registry.DEFAULT_DETECTOR).partition("@")[0]
+    else:
+        name = "skin/resnet18"
+    return os.path.join(INT8_DIR, name.replace("/", "_") + ".pt")
+
+
+def load(path):
+    if not os.path.exists(path):
+        raise RuntimeError(f"{path} not found, create it with: python -m quantize calibrate <faces dir>")
+    torch.backends.quantized.engine = ENGINE
+    return torch.jit.load(path, map_location="cpu")
+
+
+class _CpuModule(nn.Module):
+    """Runs a quantized net on CPU and gives its outputs back on the input's
+    device, so the int8 detector also works when the pipeline is on CUDA"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        outputs = self.net(x.cpu())
+        if isinstance(outputs, torch.Tensor):
+            return outputs.to(x.device)
+        return tuple(output.to(x.device) for output in outputs)
+
+
+class Int8RetinaFaceDetector(retinaface.RetinaFaceDetector):
+    def __init__(self, name=model_registry.DEFAULT_DETECTOR):
+        nn.Module.__init__(self)
+        size = name.partition("@")[2]
+        self.max_size = int(size) if size else None
+        self.net = _CpuModule(load(model_path("detector", name)))
+
+
+class Int8SkinModel(LazySkinModel):
+    _instance = None
+
+    def _load_model(self):
+        if not self._loaded:
+            import torchvision.transforms as transforms
+
+            self._model = load(model_path("skin"))
+            self._transform = transforms.Compose([
+                transforms.Resize((160, 160)),
+                transforms.ToTensor(),
+                transforms.Normalize((0.5,), (0.5,))
+            ])
+            self._loaded = True
+
+
+def skin_model():
+    model = Int8SkinModel()
+    model._load_model()
+    return model
+
+
+def load_faces(root, limit=None):
+    """RGB images of a folder, decoded like uploads (long side <= 600)"""
+    from analyze_images import iter_paths
+    from pipeline import decode_image
+
+    images = []
+    for path in iter_paths(root):
+        if limit and len(images) >= limit:
+            break
+        try:
+            with open(path, "rb") as image_file:
+                images.append((path, decode_image(image_file.read())))
+        except (OSError, ValueError) as e:
+            print(f"Skipping {path}: {e}")
+    if not images:
+        raise SystemExit(f"No images found in {root}")
+    return images
+
+
+def detector_input(img, max_size=None):
+    """Input of the RetinaFace net for an RGB image, as in `batch_detect`,
+    downscaled like `downscaled_detect` when `max_size` is given"""
+    x = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).unsqueeze(0).float()
+    _, _, h, w = x.shape
+    if max_size and max(h, w) > max_size:
+        scale = max_size / max(h, w)
+        x = F.interpolate(x, size=(max(1, round(h * scale)), max(1, round(w * scale))),
+                          mode='bilinear', align_corners=False, antialias=True)
+    return x - torch.tensor(DETECTOR_MEAN, dtype=x.dtype).view(1, 3, 1, 1)
+
+
+def skin_input(img, transform):
+    """Input of the skin ResNet18 for an RGB image, as in `LazySkinModel.predict`"""
+    from PIL import Image
+
+    img = cv2.resize(img, (160, 160), interpolation=cv2.INTER_AREA)
+    return transform(Image.fromarray(img)).unsqueeze(0)
+
+
+def skin_image(img):
+    """What the pipeline gives the skin model: the face skin of the image, or
+    None when no face is found"""
+    import functions as f
+
+    segmentation = f.segment_face(img)
+    if segmentation is None:
+        return None
+    return f.skin_mask_image(img, segmentation)
+
+
+def fp32_model(kind):
+    """The FP32 model of the registry, with the torch backend whatever backend
+    the model is configured with"""
+    if kind == "detector":
+        return model_registry.get_face_detector(backend="torch")
+    return model_registry.get_skin_model(backend="torch")
+
+
+def quantize(net, inputs):
+    """INT8 TorchScript of `net`, with activation ranges calibrated on `inputs`"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = ENGINE
+    net = copy.deepcopy(net).eval()
+    prepared = prepare_fx(net, get_default_qconfig_mapping(ENGINE), example_inputs=(inputs[0],))
+    with torch.no_grad():
+        for x in inputs:
+            prepared(x)
+    return torch.jit.script(convert_fx(prepared))
+
+
+def calibration_inputs(kind, images):
+    if kind == "detector":
+        # Both the full size images and the quality=fast ones go through the net
+        return [detector_input(img, max_size) for _, img in images
+                for max_size in (None, model_registry.FAST_DETECT_SIZE)]
+    transform = fp32_model("skin")._transform
+    skin_images = [skin_image(img) for _, img in images]
+    return [skin_input(img, transform) for img in skin_images if img is not None]
+
+
+def calibrate(kind, images):
+    """Quantize a model with `images` and save it to `model_path(kind)`"""
+    model = fp32_model(kind)
+    net = model.net if kind == "detector" else model._model
+    inputs = calibration_inputs(kind, images)
+    if not inputs:
+        raise SystemExit(f"No faces found to calibrate the {kind} model")
+    start = time.perf_counter()
+    quantized = quantize(net, inputs)
+    path = model_path(kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.jit.save(quantized, path)
+    print(f"Saved INT8 {kind} to {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB, "
+          f"calibrated on {len(inputs)} inputs in {time.perf_counter() - start:.1f}s)")
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _match_boxes(expected, actual):
+    """IoU of each FP32 box with its best INT8 box"""
+    from torchvision.ops import box_iou
+
+    if len(expected) == 0:
+        return []
+    if len(actual) == 0:
+        return [0.0] * len(expected)
+    return box_iou(expected, actual).max(dim=1).values.tolist()
+
+
+def compare_detector(images, iou_threshold):
+    fp32_net = fp32_model("detector").net
+    int8_net = load(model_path("detector"))
+    ious, fp32_faces, int8_faces, fp32_ms, int8_ms = [], 0, 0, [], []
+    for _, img in images:
+        x = torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1).unsqueeze(0)
+        expected, ms = _timed(retinaface.batch_detect, fp32_net, x, 0.8)
+        fp32_ms.append(ms)
+        actual, ms = _timed(retinaface.batch_detect, int8_net, x, 0.8)
+        int8_ms.append(ms)
+        fp32_faces += len(expected['rects'])
+        int8_faces += len(actual['rects'])
+        ious.extend(_match_boxes(expected['rects'], actual['rects']))
+    matched = [iou for iou in ious if iou >= iou_threshold]
+    return {
+        "images": len(images),
+        "fp32_faces": fp32_faces,
+        "int8_faces": int8_faces,
+        "recall": len(matched) / len(ious) if ious else None,
+        "mean_iou": statistics.mean(matched) if matched else None,
+        "fp32_ms": statistics.median(fp32_ms),
+        "int8_ms": statistics.median(int8_ms),
+        "fp32_mb": round(model_registry._module_size_mb(fp32_net), 2),
+        "int8_mb": round(os.path.getsize(model_path("detector")) / 1024 / 1024, 2),
+    }
+
+
+def compare_skin(images):
+    fp32 = fp32_model("skin")
+    int8_net = load(model_path("skin"))
+    agree, confusion, fp32_ms, int8_ms, faces = 0, {}, [], [], 0
+    for _, img in images:
+        masked = skin_image(img)
+        if masked is None:
+            continue
+        faces += 1
+        x = skin_input(masked, fp32._transform)
+        with torch.inference_mode():
+            expected, ms = _timed(fp32._model, x)
+            fp32_ms.append(ms)
+            actual, ms = _timed(int8_net, x)
+            int8_ms.append(ms)
+        pair = f"{expected.argmax().item()}->{actual.argmax().item()}"
+        confusion[pair] = confusion.get(pair, 0) + 1
+        agree += expected.argmax().item() == actual.argmax().item()
+    return {
+        "images": len(images),
+        "faces": faces,
+        "season_agreement": agree / faces if faces else None,
+        "seasons": dict(sorted(confusion.items())),
+        "fp32_ms": statistics.median(fp32_ms) if fp32_ms else None,
+        "int8_ms": statistics.median(int8_ms) if int8_ms else None,
+        "fp32_mb": round(model_registry._module_size_mb(fp32), 2),
+        "int8_mb": round(os.path.getsize(model_path("skin")) / 1024 / 1024, 2),
+    }
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def print_report(report):
+    detector = report.get("detector")
+    if detector:
+        print(f"detector: {detector['fp32_faces']} FP32 faces in {detector['images']} images, "
+              f"{detector['int8_faces']} INT8; recall {_fmt(detector['recall'], '.1%')} "
+              f"at IoU >= {report['iou']}, mean IoU {_fmt(detector['mean_iou'], '.3f')}")
+        print(f"          {_fmt(detector['fp32_ms'], '.1f')} -> {_fmt(detector['int8_ms'], '.1f')} ms per image, "
+              f"{detector['fp32_mb']} -> {detector['int8_mb']} MB")
+    skin = report.get("skin")
+    if skin:
+        print(f"skin:     season agreement {_fmt(skin['season_agreement'], '.1%')} over {skin['faces']} faces "
+              f"(FP32->INT8: {skin['seasons']})")
+        print(f"          {_fmt(skin['fp32_ms'], '.1f')} -> {_fmt(skin['int8_ms'], '.1f')} ms per image, "
+              f"{skin['fp32_mb']} -> {skin['int8_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stub-models", action="store_true",
+                        help="Use the stand-in models of benchmarks.stub_models (no weights needed)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = subparsers.add_parser("calibrate", help="Quantize the models with a folder of faces")
+    calibrate_parser.add_argument("faces", help="Folder of sample face images")
+    calibrate_parser.add_argument("models", nargs="*", help=f"Any of {', '.join(KINDS)} (default: all)")
+    calibrate_parser.add_argument("--limit", type=int, default=200, help="Calibration images to use")
+    report_parser = subparsers.add_parser("report", help="Compare the INT8 models with FP32")
+    report_parser.add_argument("faces", help="Folder of face images, ideally not the calibration ones")
+    report_parser.add_argument("models", nargs="*", help=f"Any of {', '.join(KINDS)} (default: all)")
+    report_parser.add_argument("--limit", type=int)
+    report_parser.add_argument("--iou", type=float, default=0.5, help="IoU for an INT8 box to match")
+    report_parser.add_argument("-o", "--output", help="Write the report as JSON")
+    args = parser.parse_args()
+    unknown = set(args.models) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown models: {', '.join(sorted(unknown))}")
+    models = args.models or KINDS
+
+    if args.stub_models:
+        from benchmarks import stub_models
+        stub_models.install()
+    torch.set_grad_enabled(False)
+    images = load_faces(args.faces, args.limit)
+
+    if args.command == "calibrate":
+        for kind in models:
+            calibrate(kind, images)
+        return
+
+    report = {"faces": args.faces, "iou": args.iou}
+    if "detector" in models:
+        report["detector"] = compare_detector(images, args.iou)
+    if "skin" in models:
+        report["skin"] = compare_skin(images)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
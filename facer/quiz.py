@@ -0,0 +1,213 @@
+"""Color quiz answers, the quiz palette prompt and the quiz response memo.
+
+The quiz has six multiple-choice questions, so there are only a few thousand
+distinct answer sets. Answers are normalized to the canonical option text and
+the LLM's palette for each set is memoized; the warm-up command fills the memo
+ahead of time:
+
+    python quiz.py warm --base-url http://127.0.0.1:8001/api/v1 --db quiz.db
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import re
+import time
+
+from llm_client import finished_normally, llm, response_content
+from result_cache import ResultCache
+
+# Options as offered by frontend-in/src/ColorQuiz.jsx
+QUIZ_OPTIONS = {
+    "undertone": [
+        "Cool (blue/pink undertones, silver jewelry suits me)",
+        "Warm (yellow/golden undertones, gold jewelry suits me)",
+        "Neutral (a mix of both or hard to tell)",
+    ],
+    "hairColor": [
+        "Very light blonde",
+        "Warm blonde or strawberry blonde",
+        "Light brown",
+        "Medium brown",
+        "Dark brown or black",
+        "Red or auburn",
+        "Gray or white",
+    ],
+    "eyeColor": [
+        "Light blue or green",
+        "Gray or hazel",
+        "Amber or golden brown",
+        "Deep brown or black",
+    ],
+    "sunReaction": [
+        "Burns easily, rarely tans (likely cool undertone)",
+        "Burns slightly, then tans (neutral)",
+        "Tans easily, rarely burns (warm undertone)",
+    ],
+    "skinDepth": ["Fair/light", "Medium", "Olive", "Deep/dark"],
+    "veinColor": ["Bluish/purplish", "Greenish", "A mix of both / hard to tell"],
+}
+
+QUIZ_FIELDS = tuple(QUIZ_OPTIONS)
+
+_CANONICAL = {field: {option.casefold(): option for option in options}
+              for field, options in QUIZ_OPTIONS.items()}
+
+
+def _normalize_text(value):
+    return re.sub(r"\s+", " ", str(value)).strip()
+
+
+def normalize_quiz_answers(answers):
+    """The six quiz fields with whitespace collapsed and known options in canonical case.
+
+    Free-text answers that don't match an option are kept (normalized), extra
+    fields are dropped and missing ones are None, as in the prompt.
+    """
+    normalized = {}
+    for field in QUIZ_FIELDS:
+        value = answers.get(field)
+        if value is not None:
+            value = _normalize_text(value)
+            value = _CANONICAL[field].get(value.casefold(), value)
+        normalized[field] = value
+    return normalized
+
+
+def build_quiz_palette_prompt(quiz_answers):
+    return f"""
+You are a color theory expert analyzing personal color palettes.
+
+User's self-reported features:
+- Skin undertone: {quiz_answers.get('undertone')}
+- Natural hair color: {quiz_answers.get('hairColor')}
+- Natural eye color: {quiz_answers.get('eyeColor')}
+- Skin reaction to sun: {quiz_answers.get('sunReaction')}
+- Skin depth/tone: {quiz_answers.get('skinDepth')}
+- Vein color: {quiz_answers.get('veinColor')}
+
+Based on these features, analyze the user's likely personal color season (Spring, Summer, Autumn, Winter) using the same logic as if you had hex codes. Match their traits to the seasonal color theory below.
+User variety of shades for a diverse palette
+...
+
+Return ONLY a valid JSON object in this format:
+{{
+  "season": "...",
+  "why": "...",
+  "palettes": {{
+    "Primary and Secondary Colors": ["- #HEX (Color Name)", ...],
+    "Warm Tones": ["- #HEX (Color Name)", ...],
+    "Cool Tones": ["- #HEX (Color Name)", ...],
+    "Neutral or Black Tones": ["- #HEX (Color Name)", ...]
+  }},
+  "clothing": ["- #HEX (Color Name)", ...],
+  "makeup": [
+    {{ "part": "Lip", "hex": "...", "name": "..." }},
+    {{ "part": "Eyes", "hex": "...", "name": "..." }},
+    {{ "part": "Cheeks", "hex": "...", "name": "..." }}
+  ]
+}}
+Do NOT include markdown, code blocks, or any text outside the JSON. Do not use hex codes and asterics in the why section. Do not use words like user, use you in statements
+"""
+
+
+class QuizMemo:
+    """Memoized quiz palettes keyed on (model, normalized answers).
+
+    Backed by a `ResultCache` (in-memory LRU plus an optional sqlite file), so
+    a memo warmed offline with `python quiz.py warm` can be shipped with the
+    server via QUIZ_CACHE_DB. Only LLM responses that finished normally are stored.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, disk_path=None):
+        self.store = ResultCache(
+            max_entries=max_entries if max_entries is not None else int(os.getenv("QUIZ_CACHE_SIZE", "4096")),
+            ttl=ttl if ttl is not None else float(os.getenv("QUIZ_CACHE_TTL", str(30 * 86400))),
+            # "" rather than None, so the memo never falls back to RESULT_CACHE_DB
+            disk_path=disk_path if disk_path is not None else os.getenv("QUIZ_CACHE_DB", ""),
+            name="quiz")
+
+    @staticmethod
+    def make_key(answers, model=None):
+        payload = json.dumps([model or llm.model, answers], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, answers, model=None):
+        entry = self.store.get(self.make_key(answers, model), ("llm_response",))
+        return entry["llm_response"] if entry and "llm_response" in entry else None
+
+    async def get_or_fetch(self, answers, prompt, api_key, model=None):
+        """LLM palette text for normalized `answers`, from the memo when possible"""
+        content = self.get(answers, model)
+        if content is not None:
+            return content
+        llm_response = await llm.chat(prompt, api_key, model=model)
+        content = response_content(llm_response)
+        if finished_normally(llm_response):
+            self.put(answers, content, model)
+        return content
+
+    def put(self, answers, content, model=None):
+        """Store the palette text of a successful LLM call"""
+        self.store.put(self.make_key(answers, model), {"llm_response": content})
+
+    def stats(self):
+        return self.store.stats()
+
+
+quiz_memo = QuizMemo()
+
+
+def all_answer_sets():
+    """Every combination of the offered quiz options"""
+    for values in itertools.product(*QUIZ_OPTIONS.values()):
+        yield dict(zip(QUIZ_FIELDS, values))
+
+
+async def warm(memo, api_key, limit=None, concurrency=8):
+    """Fill `memo` with the palette of every answer set (or the first `limit`)"""
+    answer_sets = list(itertools.islice(all_answer_sets(), limit))
+    semaphore = asyncio.Semaphore(concurrency)
+    fetched = 0
+
+    async def fill(answers):
+        nonlocal fetched
+        if memo.get(answers) is not None:
+            return
+        async with semaphore:
+            # The memo holds the answers; skip the client's own response cache
+            llm_response = await llm.chat(build_quiz_palette_prompt(answers), api_key, use_cache=False)
+        if finished_normally(llm_response):
+            memo.put(answers, response_content(llm_response))
+            fetched += 1
+
+    start = time.time()
+    await asyncio.gather(*(fill(answers) for answers in answer_sets))
+    await llm.aclose()
+    print(f"Warmed {fetched} of {len(answer_sets)} quiz answer sets in {time.time() - start:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    warm_parser = subparsers.add_parser("warm", help="Precompute quiz palettes into a sqlite memo")
+    warm_parser.add_argument("--db", default=os.getenv("QUIZ_CACHE_DB", "quiz_cache.db"))
+    warm_parser.add_argument("--base-url", help="LLM endpoint, e.g. the stub_servers.openrouter_app URL")
+    warm_parser.add_argument("--model")
+    warm_parser.add_argument("--api-key", default=os.getenv("OPENROUTER_API_KEY", "stub"))
+    warm_parser.add_argument("--limit", type=int)
+    warm_parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.base_url:
+        llm.base_url = args.base_url.rstrip("/")
+    if args.model:
+        llm.model = args.model
+    memo = QuizMemo(max_entries=0, disk_path=args.db)
+    asyncio.run(warm(memo, args.api_key, args.limit, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class ResultCache:
+    """Content-addressed cache of extracted features.
+
+    Keys are a hash of the normalized decoded image plus the pipeline version,
+    so re-uploads of the same selfie hit the cache whatever the file name or
+    endpoint. Entries live in an in-memory LRU capped at `max_entries` with a
+    TTL, and optionally in a sqlite file (`disk_path`) that survives restarts
+    and is shared by all workers on the machine.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, disk_path=None, name="features"):
+        self.name = name
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("RESULT_CACHE_SIZE", "256"))
+        self.ttl = ttl if ttl is not None else float(os.getenv("RESULT_CACHE_TTL", "3600"))
+        disk_path = disk_path if disk_path is not None else os.getenv("RESULT_CACHE_DB")
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._db.commit()
+
+        self._puts = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(img, version):
+        """Key of a decoded image (ndarray) for a given pipeline version"""
+        digest = hashlib.sha256()
+        digest.update(f"v{version}:{img.shape}:{img.dtype}".encode())
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key, required=()):
+        """Cached value for `key` or None.
+
+        Counts a hit only if the value has every key in `required`; a partial
+        entry is still returned (so callers can fill in the rest) but counts
+        as a miss.
+        """
+        now = time.time()
+        with self._lock:
+            value = None
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                value = entry[1]
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                value = self._disk_get(key, now)
+                if value is not None:
+                    self._remember(key, value, now)
+                    if all(name in value for name in required):
+                        self.disk_hits += 1
+
+            hit = value is not None and all(name in value for name in required)
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.record_cache_lookup(self.name, hit)
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        now = time.time()
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                                 (key, json.dumps(value), now + self.ttl))
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    self._db.execute("DELETE FROM results WHERE expires <= ?", (now,))
+                self._db.commit()
+
+    def _remember(self, key, value, now):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT value FROM results WHERE key = ? AND expires > ?",
+                               (key, now)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+cache = ResultCache()
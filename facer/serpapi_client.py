@@ -0,0 +1,89 @@
+import asyncio
+import os
+import re
+
+import httpx
+
+from result_cache import ResultCache
+from singleflight import SingleFlight
+
+DEFAULT_BASE_URL = "https://serpapi.com"
+
+
+def normalize_query(q):
+    """Cache key form of a search query: case and whitespace don't matter"""
+    return re.sub(r"\s+", " ", q).strip().casefold()
+
+
+class SerpApiClient:
+    """Async SerpAPI image search client.
+
+    Connections are pooled in one `httpx.AsyncClient` with timeouts, results
+    are cached on the normalized query for `cache_ttl` seconds and concurrent
+    identical queries share one upstream call. Point `base_url` (or
+    SERPAPI_BASE_URL) at `stub_servers.serpapi_app` to run without the real API.
+    """
+
+    def __init__(self, base_url=None, api_key=None, timeout=None, max_connections=None,
+                 cache_size=None, cache_ttl=None):
+        self.base_url = (base_url or os.getenv("SERPAPI_BASE_URL", DEFAULT_BASE_URL)).rstrip("/")
+        self.api_key = api_key or os.getenv("SERPAPI_KEY")
+        self.timeout = httpx.Timeout(timeout or float(os.getenv("SERPAPI_TIMEOUT", "15")), connect=5)
+        self.limits = httpx.Limits(
+            max_connections=max_connections or int(os.getenv("SERPAPI_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=10)
+        self.cache = ResultCache(
+            max_entries=cache_size if cache_size is not None else int(os.getenv("SERPAPI_CACHE_SIZE", "1024")),
+            ttl=cache_ttl if cache_ttl is not None else float(os.getenv("SERPAPI_CACHE_TTL", "21600")),
+            disk_path="", name="serpapi")
+        self.flights = SingleFlight()
+        self.upstream_calls = 0
+        self._client = None
+        self._loop = None
+
+    def _get_client(self):
+        # An AsyncClient is bound to the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._loop = loop
+        return self._client
+
+    async def search_images(self, q):
+        """SerpAPI image results for `q` as (status_code, response JSON).
+
+        Only the cache and single-flight key is normalized; SerpAPI gets `q`
+        as the caller wrote it, so the casing of names and brands is kept.
+        """
+        key = normalize_query(q)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return 200, cached
+        return await self.flights.do(key, self._fetch, key, q)
+
+    async def _fetch(self, key, query):
+        print(f"[SerpAPI Proxy] Requesting: {query}")
+        self.upstream_calls += 1
+        response = await self._get_client().get(
+            "/search.json", params={"q": query, "tbm": "isch", "api_key": self.api_key})
+        print(f"[SerpAPI Proxy] Response status: {response.status_code}")
+        try:
+            data = response.json()
+        except ValueError:
+            data = {"error": response.text}
+        if response.status_code == 200 and "error" not in data:
+            self.cache.put(key, data)
+        else:
+            print(f"[SerpAPI Proxy] Error response: {response.text}")
+        return response.status_code, data
+
+    def stats(self):
+        return {**self.cache.stats(), **self.flights.stats(), "upstream_calls": self.upstream_calls}
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+serpapi = SerpApiClient()
@@ -0,0 +1,35 @@
+import asyncio
+
+
+class SingleFlight:
+    """Coalesces concurrent async calls that share a key.
+
+    The first caller for a key starts `fn(*args)` as a task; callers that
+    arrive while it is still running await the same task instead of starting
+    their own. The task is shielded, so a caller that disconnects doesn't
+    cancel the work for the others. Every caller gets the same result object;
+    copy it before mutating.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self._tasks.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def stats(self):
+        return {"in_flight": len(self._tasks), "calls": self.calls, "shared": self.shared}
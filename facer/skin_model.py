@@ -7,6 +7,8 @@ import os
 import gc
 import traceback
 
+from metrics import stage
+
 class LazySkinModel:
     _instance = None
     _model = None
@@ -64,6 +66,20 @@ class LazySkinModel:
         import cv2
         import numpy as np
         
+        # Raw bytes of an encoded image, e.g. an upload
+        if isinstance(img, (bytes, bytearray, memoryview)):
+            img = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                raise ValueError("Could not decode image")
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        # Already decoded RGB image (h x w x 3, uint8), e.g. from the feature pipeline
+        if isinstance(img, np.ndarray):
+            cv_img_rgb = cv2.resize(img, (160, 160), interpolation=cv2.INTER_AREA)
+            image = Image.fromarray(cv_img_rgb)
+            image = self._transform(image).unsqueeze(0)
+            return self._predict_tensor(image)
+
         # Read and compress image
         cv_img = cv2.imread(img)
         if cv_img is not None:
@@ -77,8 +93,10 @@ class LazySkinModel:
             image = image.resize((160, 160), Image.Resampling.LANCZOS)
         
         image = self._transform(image).unsqueeze(0)
+        return self._predict_tensor(image)
 
-        with torch.no_grad():
+    def _predict_tensor(self, image):
+        with torch.no_grad(), stage("skin_resnet"):
             output = self._model(image)
         pred_index = output.argmax().item()
         print("Decided color: ", pred_index)
@@ -89,11 +107,7 @@ class LazySkinModel:
         
         return pred_index
 
-# Global lazy model instance
-_lazy_model = None
-
 def get_season(img):
-    global _lazy_model
-    if _lazy_model is None:
-        _lazy_model = LazySkinModel()
-    return _lazy_model.predict(img)
+    # Shared, loaded-once instance from the process-wide model registry
+    import model_registry
+    return model_registry.get_skin_model().predict(img)
@@ -0,0 +1,160 @@
+import json
+import re
+
+# Objects whose members are emitted one by one instead of as a whole
+NESTED_SECTIONS = ("palettes",)
+
+
+# A string (kept as is) or a comma right before a closing bracket (dropped)
+_TRAILING_COMMA = re.compile(r'("(?:\\.|[^"\\])*")|,\s*(?=[\]}])')
+
+
+def loads_lenient(text):
+    """json.loads that also accepts trailing commas, which LLMs copy from the
+    examples in our prompts (`["...", "...",]`)"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return json.loads(_TRAILING_COMMA.sub(lambda m: m.group(1) or "", text))
+
+
+def sse_event(event, data):
+    """One server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class _Frame:
+    __slots__ = ("kind", "key", "value_start", "expect_key")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.key = None
+        self.value_start = None
+        self.expect_key = kind == "{"
+
+
+class SectionParser:
+    """Incremental scanner for the palette JSON an LLM is still writing.
+
+    `feed` takes the next chunk of text and returns the (path, value) of
+    every section that completed in it: each top-level member ("season",
+    "why", "makeup", ...) and each member of the objects in `nested`
+    ("palettes" -> ["palettes", "Warm Tones"]). Text before the first "{"
+    (e.g. a markdown fence) is ignored. Trailing commas are tolerated; values
+    that still aren't valid JSON on their own are skipped, and the full
+    response is still sent at the end.
+    """
+
+    def __init__(self, nested=NESTED_SECTIONS):
+        self.nested = nested
+        self.text = ""
+        self.pos = 0
+        self.stack = []
+        self.done = False
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        sections = []
+        while self.pos < len(self.text) and not self.done:
+            self._step(self.text[self.pos], self.pos, sections)
+            self.pos += 1
+        return sections
+
+    def _step(self, c, i, sections):
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif c == "\\":
+                self.escape = True
+            elif c == '"':
+                self.in_string = False
+                self._string_end(i, sections)
+            return
+
+        if not self.stack:
+            if c == "{":
+                self.stack.append(_Frame(c))
+            return
+
+        top = self.stack[-1]
+        if c == '"':
+            self.in_string = True
+            self.string_start = i
+            if not top.expect_key:
+                self._value_start(top, i)
+        elif c in "{[":
+            self._value_start(top, i)
+            self.stack.append(_Frame(c))
+        elif c in "}]":
+            self._value_end(i, sections)
+            self.stack.pop()
+            if self.stack:
+                self._value_end(i + 1, sections)
+            else:
+                self.done = True
+        elif c == ":":
+            top.expect_key = False
+        elif c == ",":
+            self._value_end(i, sections)
+            top.expect_key = top.kind == "{"
+        elif not c.isspace():
+            self._value_start(top, i)
+
+    def _value_start(self, frame, i):
+        if frame.value_start is None:
+            frame.value_start = i
+
+    def _string_end(self, i, sections):
+        top = self.stack[-1]
+        if top.expect_key:
+            try:
+                top.key = json.loads(self.text[self.string_start:i + 1])
+            except ValueError:
+                top.key = None
+        elif top.value_start == self.string_start:
+            self._value_end(i + 1, sections)
+
+    def _value_end(self, end, sections):
+        """Close the value in the innermost frame that ends at `end` (exclusive)"""
+        frame = self.stack[-1]
+        if frame.value_start is None:
+            return
+        start, frame.value_start = frame.value_start, None
+        if frame.kind != "{":
+            return
+
+        path = [f.key for f in self.stack]
+        if len(path) == 1 and path[0] in self.nested:
+            return
+        if len(path) > 2 or (len(path) == 2 and path[0] not in self.nested):
+            return
+        try:
+            value = loads_lenient(self.text[start:end])
+        except ValueError:
+            return
+        sections.append((path, value))
+
+
+async def palette_events(prompt_text, chunks):
+    """SSE events for an LLM completion streamed as `chunks` (async iterable of text).
+
+    Emits "token" for every chunk, "section" for every palette section as
+    soon as its JSON is complete and "done" with the full response, or
+    "error" if the LLM call fails.
+    """
+    parser = SectionParser()
+    parts = []
+    try:
+        async for text in chunks:
+            parts.append(text)
+            yield sse_event("token", {"text": text})
+            for path, value in parser.feed(text):
+                yield sse_event("section", {"path": path, "value": value})
+    except Exception as e:
+        yield sse_event("error", {"detail": f"Error: {str(e)}"})
+        return
+
+    yield sse_event("done", {"llm_response": "".join(parts), "prompt": prompt_text})
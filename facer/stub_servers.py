@@ -0,0 +1,124 @@
+"""Local stand-ins for the external APIs, for tests, load tests and offline runs.
+
+    uvicorn stub_servers:openrouter_app --port 8001
+    uvicorn stub_servers:serpapi_app --port 8002
+    OPENROUTER_BASE_URL=http://127.0.0.1:8001/api/v1 SERPAPI_BASE_URL=http://127.0.0.1:8002 uvicorn main:app
+
+STUB_LLM_DELAY_MS and STUB_SERPAPI_DELAY_MS add a fixed delay to every
+response to mimic the real APIs' latency; STUB_LLM_TOKEN_DELAY_MS is the delay
+between chunks of a streamed completion.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import StreamingResponse
+
+SEASONS = ["Spring", "Summer", "Autumn", "Winter"]
+
+SEASON_PALETTES = {
+    "Spring": ["#FFDAB9 (Peach Puff)", "#FF7F50 (Coral)", "#FFD700 (Gold)", "#98FB98 (Pale Green)",
+               "#40E0D0 (Turquoise)", "#F5DEB3 (Wheat)"],
+    "Summer": ["#E6E6FA (Lavender)", "#B0C4DE (Light Steel Blue)", "#DB7093 (Pale Violet Red)",
+               "#778899 (Light Slate Gray)", "#C8A2C8 (Lilac)", "#F0F8FF (Alice Blue)"],
+    "Autumn": ["#8B4513 (Saddle Brown)", "#CD853F (Peru)", "#B8860B (Dark Goldenrod)",
+               "#556B2F (Dark Olive Green)", "#A0522D (Sienna)", "#D2691E (Chocolate)"],
+    "Winter": ["#000080 (Navy)", "#DC143C (Crimson)", "#FFFFFF (White)", "#000000 (Black)",
+               "#4B0082 (Indigo)", "#008080 (Teal)"],
+}
+
+
+def stub_palette(prompt):
+    """Deterministic palette answer in the JSON format the prompts ask for"""
+    digest = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16)
+    season = SEASONS[digest % len(SEASONS)]
+    colors = ["- " + color for color in SEASON_PALETTES[season]]
+    return json.dumps({
+        "season": season,
+        "why": f"Your features harmonize with the {season} palette.",
+        "palettes": {
+            "Primary and Secondary Colors": colors,
+            "Warm Tones": colors[:3],
+            "Cool Tones": colors[3:],
+            "Neutral or Black Tones": colors[::2],
+        },
+        "More Colors": colors[1::2],
+        "makeup": [
+            {"part": "Lip", "hex": colors[0][2:9], "name": "Lip"},
+            {"part": "Eyes", "hex": colors[1][2:9], "name": "Eyes"},
+            {"part": "Cheeks", "hex": colors[2][2:9], "name": "Cheeks"},
+        ],
+    }, indent=2)
+
+
+openrouter_app = FastAPI()
+openrouter_app.state.requests = 0
+
+
+@openrouter_app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    openrouter_app.state.requests += 1
+    await asyncio.sleep(float(os.getenv("STUB_LLM_DELAY_MS", "0")) / 1000)
+
+    prompt = body["messages"][-1]["content"]
+    content = stub_palette(prompt)
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(content, body.get("model")), media_type="text/event-stream")
+    return {
+        "id": f"stub-{openrouter_app.state.requests}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+    }
+
+
+async def stream_completion(content, model, chunk_size=16):
+    """OpenAI-style SSE chunks of `content`, as OpenRouter sends with stream=true"""
+    delay = float(os.getenv("STUB_LLM_TOKEN_DELAY_MS", "0")) / 1000
+    yield ": OPENROUTER PROCESSING\n\n"
+    for start in range(0, len(content), chunk_size):
+        chunk = {
+            "id": f"stub-{openrouter_app.state.requests}",
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content[start:start + chunk_size]},
+                         "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(delay)
+    # The last chunk has an empty delta and the finish reason
+    chunk["choices"] = [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+serpapi_app = FastAPI()
+serpapi_app.state.requests = 0
+
+
+@serpapi_app.get("/search.json")
+async def search(q: str = Query(...), tbm: str = Query(None), api_key: str = Query(None)):
+    serpapi_app.state.requests += 1
+    await asyncio.sleep(float(os.getenv("STUB_SERPAPI_DELAY_MS", "0")) / 1000)
+
+    digest = hashlib.sha256(q.encode("utf-8")).hexdigest()
+    return {
+        "search_metadata": {"id": digest[:24], "status": "Success"},
+        "search_parameters": {"q": q, "tbm": tbm},
+        "images_results": [{
+            "position": i + 1,
+            "title": f"{q} {i + 1}",
+            "thumbnail": f"https://example.com/{digest[:12]}/{i}.jpg",
+            "original": f"https://example.com/{digest[:12]}/{i}_full.jpg",
+            "link": f"https://example.com/{digest[:12]}/{i}",
+        } for i in range(10)],
+    }
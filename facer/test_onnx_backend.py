@@ -0,0 +1,38 @@
+"""Parity of the ONNX Runtime backend with torch, on the stand-in models.
+
+    cd facer && python -m pytest test_onnx_backend.py
+
+Exports each net like `python -m onnx_backend --stub-models export` and
+compares it like `... check`, so no weights or network are needed.
+"""
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+import model_registry
+import onnx_backend
+from benchmarks import stub_models
+
+
+@pytest.fixture(scope="module", autouse=True)
+def stand_ins(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("STUB_PARSER_LAYERS", "1")
+        patch.setattr(onnx_backend, "ONNX_DIR", str(tmp_path_factory.mktemp("onnx")))
+        stub_models.install()
+        yield
+
+
+@pytest.mark.parametrize("kind", onnx_backend.KINDS)
+def test_onnx_matches_torch(kind):
+    onnx_backend.export(kind)
+    rows = onnx_backend.check(kind, [(450, 600), (300, 200)], batch=2, rtol=1e-3, atol=1e-4, rounds=1)
+    assert rows and all(row["ok"] for row in rows), rows
+
+
+def test_torch_net_keeps_the_configured_backend():
+    backends = dict(model_registry.BACKENDS)
+    for kind in onnx_backend.KINDS:
+        onnx_backend.torch_net(kind)
+    assert model_registry.BACKENDS == backends
@@ -0,0 +1,90 @@
+import time
+
+import cv2
+import numpy as np
+
+import functions as f
+import model_registry
+
+# Set by main once the warm-up has finished (or failed)
+state = {"ready": False, "error": None, "seconds": None, "steps": {}}
+
+
+def synthetic_face(size=600):
+    """RGB image of a plain cartoon face, enough to drive every model once"""
+    img = np.full((size, size, 3), (200, 210, 220), np.uint8)
+    center = (size // 2, size // 2)
+    cv2.ellipse(img, center, (size // 4, size // 3), 0, 0, 360, (224, 172, 140), -1)
+    cv2.ellipse(img, (size // 2, size // 5), (size // 4, size // 8), 0, 180, 360, (60, 40, 30), -1)
+    for dx in (-1, 1):
+        cv2.circle(img, (size // 2 + dx * size // 10, size * 9 // 20), size // 40, (70, 90, 120), -1)
+    cv2.ellipse(img, (size // 2, size * 5 // 8), (size // 14, size // 40), 0, 0, 360, (170, 80, 90), -1)
+    return img
+
+
+def synthetic_detection(torch, h, w):
+    """Detection of the face drawn by `synthetic_face`, in the detector's output format"""
+    points = [[w * .42, h * .45], [w * .58, h * .45], [w * .5, h * .53], [w * .44, h * .62], [w * .56, h * .62]]
+    return {
+        'rects': torch.tensor([[w * .25, h * .17, w * .75, h * .83]]),
+        'points': torch.tensor([points]),
+        'scores': torch.tensor([1.0]),
+        'image_ids': torch.tensor([0]),
+    }
+
+
+def warm_up(size=600, repeats=2):
+    """Load every model and run each one on a synthetic image.
+
+    The first calls of a model are slow (lazy imports, TorchScript profiling
+    runs of FaRL, oneDNN kernel selection), so this is done before the worker
+    takes traffic. Both detectors are warmed: the default one and the
+    downscaling one of quality=fast. The parser gets a made-up detection, so
+    it runs even if the detector doesn't find the drawn face. Returns the
+    seconds taken per step.
+    """
+    steps = {}
+
+    def step(name, fn):
+        start = time.perf_counter()
+        result = fn()
+        steps[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    torch = f._lazy_import_torch()
+    facer = f._lazy_import_facer()
+    detector = step("load_detector", model_registry.get_face_detector)
+    fast_detector = step("load_fast_detector",
+                         lambda: model_registry.get_face_detector(model_registry.detector_name("fast")))
+    parser = step("load_parser", model_registry.get_face_parser)
+    skin = step("load_skin_model", model_registry.get_skin_model)
+    step("load_mediapipe", f._lazy_import_mediapipe)
+
+    img = synthetic_face(size)
+    h, w = img.shape[:2]
+    image = facer.hwc2bchw(torch.from_numpy(img)).to(device=model_registry.get_device())
+    with torch.inference_mode():
+        for i in range(repeats):
+            step(f"retinaface_{i}", lambda: detector(image))
+            step(f"retinaface_fast_{i}", lambda: fast_detector(image))
+            step(f"farl_{i}", lambda: parser(image, synthetic_detection(torch, h, w)))
+    for i in range(repeats):
+        step(f"skin_resnet_{i}", lambda: skin.predict(img))
+    step("mediapipe", lambda: f.eye_color_from_image(cv2.cvtColor(img, cv2.COLOR_RGB2BGR)))
+    return steps
+
+
+# Warm-up of this process when it is an inference worker process
+_worker_steps = None
+
+
+def warm_up_worker():
+    """Initializer of the inference worker processes: each one warms itself up
+    before it takes any job"""
+    global _worker_steps
+    _worker_steps = warm_up()
+
+
+def worker_steps():
+    """Warm-up timings of the worker process this runs in"""
+    return _worker_steps